@@ -16,48 +16,1429 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import cairo
+import collections
+import gi
+import heapq
+import itertools
+import logging
 import math
+import multiprocessing
+import sys
+import threading
 
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GdkPixbuf
+from gi.repository import GLib
 from gi.repository import GObject
 
+import exif
+import perftrace
+import tiff
+
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+try:
+    gi.require_version('Rsvg', '2.0')
+    from gi.repository import Rsvg
+    RSVG_AVAILABLE = True
+except (ImportError, ValueError):
+    RSVG_AVAILABLE = False
+
 ZOOM_STEP = 0.05
 ZOOM_MAX = 10
 ZOOM_MIN = 0.05
 
+# Duration in ms of the animation of zoom_in() and zoom_out().
+ZOOM_DURATION = 150
+
+# Kinetic panning.  The velocity, in pixels per ms, is estimated over
+# the last KINETIC_WINDOW ms of a drag, then decays with a time
+# constant of KINETIC_DECAY ms until it is below KINETIC_MIN_SPEED.
+KINETIC_WINDOW = 100
+KINETIC_DECAY = 325
+KINETIC_MIN_SPEED = 0.05
+
+
+# Size in pixels of the square tiles the image is cut into.  A
+# 256x256 ARGB32 tile takes 256KB.
+TILE_SIZE = 256
+
+# Tiles are only kept scaled to the displayed zoom up to twice their
+# size, past that they would take too much memory.
+SCALED_MAX = 2
+
+# Default budget in bytes of all the pixels kept in memory: decoded
+# images, converted and scaled tiles, animation frames and the frame
+# buffers.  It can be changed with memory_budget.set_limit().
+MEMORY_BUDGET = 96 * 1024 * 1024
+
+
+# Byte offsets of the channels of a cairo ARGB32 pixel, which is a
+# native-endian 32 bits integer.
+if sys.byteorder == 'little':
+    _CAIRO_CHANNELS = (2, 1, 0, 3)
+else:
+    _CAIRO_CHANNELS = (1, 2, 3, 0)
+
+
+def _copy_pixbuf_area(pixbuf, x, y, width, height):
+    # Unlike a sub-pixbuf, the copy has its own compact rows, so
+    # reading its pixels doesn't drag the rows of the whole parent.
+    area = GdkPixbuf.Pixbuf.new(pixbuf.get_colorspace(),
+                                pixbuf.get_has_alpha(),
+                                pixbuf.get_bits_per_sample(),
+                                width, height)
+    pixbuf.copy_area(x, y, width, height, area, 0, 0)
+    return area
+
+
+@perftrace.traced('convert')
+def _surface_from_pixbuf(pixbuf):
+    # Convert the pixbuf to the most compact cairo format that paints
+    # it the same: A8 for opaque gray pixels, which is painted as a
+    # mask by _fill_surface(), RGB24 for other opaque pixels, and
+    # ARGB32 for the rest.
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+
+    if not NUMPY_AVAILABLE or pixbuf.get_bits_per_sample() != 8:
+        if pixbuf.get_has_alpha():
+            surface_format = cairo.FORMAT_ARGB32
+        else:
+            surface_format = cairo.FORMAT_RGB24
+        surface = cairo.ImageSurface(surface_format, width, height)
+        ctx_surface = cairo.Context(surface)
+        Gdk.cairo_set_source_pixbuf(ctx_surface, pixbuf, 0, 0)
+        ctx_surface.paint()
+        return surface
+
+    channels = pixbuf.get_n_channels()
+    pixels = numpy.ndarray((height, width, channels), numpy.uint8,
+                           buffer=pixbuf.get_pixels(),
+                           strides=(pixbuf.get_rowstride(), channels, 1))
+
+    opaque = channels == 3 or (pixels[..., 3] == 255).all()
+    if opaque and (pixels[..., 0] == pixels[..., 1]).all() and \
+            (pixels[..., 1] == pixels[..., 2]).all():
+        surface = cairo.ImageSurface(cairo.FORMAT_A8, width, height)
+        surface.flush()
+        data = numpy.ndarray((height, width), numpy.uint8,
+                             buffer=surface.get_data(),
+                             strides=(surface.get_stride(), 1))
+        data[...] = pixels[..., 0]
+        surface.mark_dirty()
+        return surface
+
+    if opaque:
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    else:
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+
+    # Write the pixels straight into the surface buffer, swizzling
+    # RGB or straight RGBA into premultiplied ARGB on the way.
+    surface.flush()
+    data = numpy.ndarray((height, width, 4), numpy.uint8,
+                         buffer=surface.get_data(),
+                         strides=(surface.get_stride(), 4, 1))
+
+    red, green, blue, alpha = _CAIRO_CHANNELS
+    if opaque:
+        data[..., red] = pixels[..., 0]
+        data[..., green] = pixels[..., 1]
+        data[..., blue] = pixels[..., 2]
+        data[..., alpha] = 255
+    else:
+        opacity = pixels[..., 3].astype(numpy.uint16)
+        for channel, index in ((red, 0), (green, 1), (blue, 2)):
+            data[..., channel] = (pixels[..., index] * opacity + 127) // 255
+        data[..., alpha] = pixels[..., 3]
 
-def _surface_from_file(file_location, ctx):
-    pixbuf = GdkPixbuf.Pixbuf.new_from_file(file_location)
-    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-                                 pixbuf.get_width(), pixbuf.get_height())
-
-    ctx_surface = cairo.Context(surface)
-    Gdk.cairo_set_source_pixbuf(ctx_surface, pixbuf, 0, 0)
-    ctx_surface.paint()
+    surface.mark_dirty()
     return surface
 
 
-def _rotate_surface(surface, direction):
-    ctx = cairo.Context(surface)
-    new_surface = ctx.get_target().create_similar(
-        cairo.CONTENT_COLOR_ALPHA, surface.get_height(),
-        surface.get_width())
+def _fill_surface(ctx, surface, x, y, surface_filter):
+    # Fill the current path with the surface placed at x, y.  An A8
+    # surface, or an alpha only device surface uploaded from one,
+    # holds opaque gray pixels: the path is filled with black, then
+    # white is painted through the surface as a mask.  The clip of
+    # the context is changed.
+    if surface.get_content() != cairo.CONTENT_ALPHA:
+        ctx.set_source_surface(surface, x, y)
+        ctx.get_source().set_filter(surface_filter)
+        ctx.get_source().set_extend(cairo.EXTEND_PAD)
+        ctx.fill()
+        return
+
+    mask = cairo.SurfacePattern(surface)
+    mask.set_matrix(cairo.Matrix(x0=-x, y0=-y))
+    mask.set_filter(surface_filter)
+    mask.set_extend(cairo.EXTEND_PAD)
+    ctx.set_source_rgb(0, 0, 0)
+    ctx.fill_preserve()
+    ctx.clip()
+    ctx.set_source_rgb(1, 1, 1)
+    ctx.mask(mask)
+
+
+@perftrace.traced('upload')
+def _upload_surface(window, surface):
+    # Copy the image surface to a surface similar to the window, such
+    # as a pixmap in the X server, so painting it doesn't send its
+    # pixels again.  Returns the surface itself if the window has no
+    # device surfaces.
+    contents = {
+        cairo.FORMAT_A8: cairo.CONTENT_ALPHA,
+        cairo.FORMAT_RGB24: cairo.CONTENT_COLOR,
+    }
+    content = contents.get(surface.get_format(), cairo.CONTENT_COLOR_ALPHA)
+    device_surface = window.create_similar_surface(
+        content, surface.get_width(), surface.get_height())
+    if isinstance(device_surface, cairo.ImageSurface):
+        return surface
+
+    ctx = cairo.Context(device_surface)
+    ctx.set_operator(cairo.OPERATOR_SOURCE)
+    ctx.set_source_surface(surface, 0, 0)
+    ctx.paint()
+    return device_surface
+
+
+@perftrace.traced('scale')
+def _scale_surface(surface, scale_x, scale_y):
+    # The scaled surface keeps the format of the surface.
+    width = max(1, int(math.ceil(surface.get_width() * scale_x)))
+    height = max(1, int(math.ceil(surface.get_height() * scale_y)))
+    scaled_surface = cairo.ImageSurface(surface.get_format(), width,
+                                        height)
+
+    ctx_surface = cairo.Context(scaled_surface)
+    ctx_surface.scale(scale_x, scale_y)
+    ctx_surface.set_source_surface(surface, 0, 0)
+    ctx_surface.get_source().set_extend(cairo.EXTEND_PAD)
+    ctx_surface.paint()
+    return scaled_surface
 
-    ctx_surface = cairo.Context(new_surface)
 
-    if direction == 1:
-        ctx_surface.translate(surface.get_height(), 0)
+@perftrace.traced('rotate')
+def _orient_pixbuf(pixbuf, orientation, mirrored=False):
+    # Mirror the pixbuf horizontally, if asked, then rotate it
+    # clockwise by the given quarter turns.
+    rotations = {
+        1: GdkPixbuf.PixbufRotation.CLOCKWISE,
+        2: GdkPixbuf.PixbufRotation.UPSIDEDOWN,
+        3: GdkPixbuf.PixbufRotation.COUNTERCLOCKWISE,
+    }
+    if mirrored:
+        pixbuf = pixbuf.flip(True)
+    if orientation == 0:
+        return pixbuf
+    return pixbuf.rotate_simple(rotations[orientation])
+
+
+def _orientation_matrix(orientation, width, height, mirrored=False):
+    # Transformation from the coordinates of an image of the given
+    # size to the coordinates of the image, mirrored horizontally if
+    # asked, then rotated clockwise by the given quarter turns.
+    if orientation == 1:
+        matrix = cairo.Matrix(0, 1, -1, 0, height, 0)
+    elif orientation == 2:
+        matrix = cairo.Matrix(-1, 0, 0, -1, width, height)
+    elif orientation == 3:
+        matrix = cairo.Matrix(0, -1, 1, 0, 0, width)
     else:
-        ctx_surface.translate(0, surface.get_width())
+        matrix = cairo.Matrix()
+
+    if mirrored:
+        matrix = cairo.Matrix(-1, 0, 0, 1, width, 0).multiply(matrix)
+    return matrix
+
+
+def _time_val(milliseconds):
+    time_val = GLib.TimeVal()
+    time_val.tv_sec = int(milliseconds // 1000)
+    time_val.tv_usec = int(milliseconds % 1000) * 1000
+    return time_val
+
+
+def _is_svg(data):
+    # Whether the data starting a file is SVG, that is XML.  Only the
+    # start is looked at: raster images, whose magic numbers are
+    # binary, may well mention <svg in their text or XMP metadata,
+    # and the <svg tag may come after a long prolog.
+    start = data.lstrip(b'\xef\xbb\xbf \t\r\n')
+    return start.startswith(b'<svg') or start.startswith(b'<?xml') or \
+        start.startswith(b'<!')
+
+
+def _count_gif_frames(data):
+    # Walk the blocks of a GIF file, without decoding them, and
+    # count its images.
+    data = bytearray(data)
+    position = 13
+    if data[10] & 0x80:
+        position += 3 * (2 << (data[10] & 7))
+
+    count = 0
+    while position < len(data):
+        block = data[position]
+        if block == 0x2c:
+            # Image descriptor, then optional local color table and
+            # LZW minimum code size.
+            count += 1
+            flags = data[position + 9] if position + 9 < len(data) else 0
+            position += 10
+            if flags & 0x80:
+                position += 3 * (2 << (flags & 7))
+            position += 1
+        elif block == 0x21:
+            # Extension introducer and label.
+            position += 2
+        else:
+            break
+
+        # Skip the data sub-blocks.
+        while position < len(data):
+            size = data[position]
+            position += 1 + size
+            if size == 0:
+                break
+
+    return count
+
+
+def _transform_rectangle(matrix, x, y, width, height):
+    # Return the bounding box of the rectangle once transformed by
+    # the matrix.
+    points = [matrix.transform_point(px, py)
+              for px, py in ((x, y), (x + width, y),
+                             (x, y + height), (x + width, y + height))]
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    return (min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys))
+
+
+def _get_size(pixels):
+    # Bytes taken by a cairo image surface or a pixbuf.
+    if isinstance(pixels, cairo.ImageSurface):
+        return pixels.get_stride() * pixels.get_height()
+    return pixels.get_rowstride() * pixels.get_height()
+
+
+class MemoryBudget(object):
+    """
+    Byte budget shared by all the pixels kept in memory.
+
+    Caches of surfaces and pixbufs are PixelCache objects, whose
+    entries are charged to the budget.  When the budget is exceeded,
+    entries are evicted in least recently used order, those of
+    caches that aren't visible first.  The entry just added is never
+    evicted, nor an entry holding its cache, such as the animation
+    frame it is a tile of, so painting always makes progress.
+
+    Pixels that can't be evicted, such as decoded images, are pinned:
+    they count in the usage, leaving less room to the caches that
+    aren't visible.  Visible caches are only charged for their own
+    entries, so a pinned image larger than the limit doesn't evict
+    the tiles of the frame painted as soon as they are added.
+
+    Entries are added from the main loop only, pixels may be pinned
+    from decoding threads.
+    """
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._entries = collections.OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+
+        self.usage = 0
+        self.peak = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def set_limit(self, limit):
+        self._limit = limit
+        self._evict(None)
+
+    def get_limit(self):
+        return self._limit
+
+    def get_stats(self):
+        # Counters for debugging.
+        return {
+            'limit': self._limit,
+            'usage': self.usage,
+            'peak': self.peak,
+            'pinned': sum(self._pinned.values()),
+            'entries': len(self._entries),
+            'evictions': self.evictions,
+            'evicted_bytes': self.evicted_bytes,
+        }
+
+    def pin(self, owner, size):
+        with self._lock:
+            self.usage += size - self._pinned.get(owner, 0)
+            self._pinned[owner] = size
+            self.peak = max(self.peak, self.usage)
+
+    def unpin(self, owner):
+        with self._lock:
+            self.usage -= self._pinned.pop(owner, 0)
+
+    def _add(self, cache, key, size):
+        entry = (cache, key)
+        with self._lock:
+            self._entries[entry] = size
+            self.usage += size
+            self.peak = max(self.peak, self.usage)
+        self._evict(entry)
+
+    def _touch(self, cache, key):
+        entry = (cache, key)
+        self._entries[entry] = self._entries.pop(entry)
+
+    def _remove(self, cache, key):
+        with self._lock:
+            self.usage -= self._entries.pop((cache, key))
+
+    def _evict(self, added):
+        if self.usage <= self._limit:
+            return
 
-    ctx_surface.rotate(math.pi / 2 * direction)
+        pinned = sum(self._pinned.values())
+        for visible in (False, True):
+            # Pinned pixels aren't charged to the visible caches.
+            limit = self._limit + pinned if visible else self._limit
+            for entry in list(self._entries.keys()):
+                if self.usage <= limit:
+                    break
+                # Releasing an entry, such as an animation frame, may
+                # have removed the entries of the caches it holds.
+                if entry not in self._entries:
+                    continue
+                cache, key = entry
+                if entry == added or cache.visible != visible:
+                    continue
+                if added is not None and cache._holds(key, added[0]):
+                    continue
+                self.evictions += 1
+                self.evicted_bytes += self._entries[entry]
+                cache.remove(key)
+
+
+class PixelCache(object):
+    """
+    LRU cache of surfaces or pixbufs, charged to a MemoryBudget.
+
+    Entries may be evicted by the budget at any time, except while
+    being added.  Visible caches, those holding what is on screen,
+    are only evicted once the others are empty.  The release
+    callback, if any, is called with the values removed.
+    """
+
+    def __init__(self, budget, release=None):
+        self._budget = budget
+        self._release = release
+        self._entries = {}
+        self.visible = False
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return list(self._entries.keys())
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._budget._touch(self, key)
+        return value
+
+    def add(self, key, value, size=None):
+        self.remove(key)
+        self._entries[key] = value
+        if size is None:
+            size = _get_size(value)
+        self._budget._add(self, key, size)
+
+    def _holds(self, key, cache):
+        # Whether the value holds the cache, which releasing the
+        # value would clear.
+        get_caches = getattr(self._entries.get(key), 'get_caches', None)
+        return get_caches is not None and cache in get_caches()
+
+    def remove(self, key):
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._budget._remove(self, key)
+            if self._release is not None:
+                self._release(value)
+
+    def clear(self):
+        for key in self.keys():
+            self.remove(key)
+
+
+memory_budget = MemoryBudget(MEMORY_BUDGET)
+
+
+class _TileJob(object):
+
+    def __init__(self, function, args, done_cb, user_data):
+        self.function = function
+        self.args = args
+        self.done_cb = done_cb
+        self.user_data = user_data
+        self.priority = None
+        self.result = None
+        self.cancelled = False
+        self.started = False
+        self.finished = False
+        self.delivered = False
+
+
+class TilePool(object):
+    """
+    Worker threads converting, rendering and scaling tiles in
+    parallel, one per processor.
+
+    Queued jobs are run lowest priority first, the view uses the
+    distance of the tile from the centre of the viewport.  As the
+    viewport moves, queued jobs are given new priorities, or
+    cancelled.  Each job works on its own buffer, which done_cb
+    receives from the main loop as the job result, or right away
+    for the jobs waited for with wait().
+
+    Jobs must only be given arguments that nothing modifies while
+    they run, such as pixbufs and surfaces, and never caches.
+    """
+
+    def __init__(self, count):
+        self._count = count
+        self._threads = []
+        self._queue = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._queued = threading.Condition(self._lock)
+        self._finished = threading.Condition(self._lock)
+
+    def submit(self, function, args, priority, done_cb, *user_data):
+        # Queue function(*args), then call done_cb(job, *user_data)
+        # from the main loop.  Returns the job.
+        job = _TileJob(function, args, done_cb, user_data)
+        while len(self._threads) < self._count:
+            thread = threading.Thread(
+                target=self._worker_thread,
+                name='TileWorker-%d' % len(self._threads))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self.prioritize(job, priority)
+        return job
+
+    def prioritize(self, job, priority):
+        # Entries with an outdated priority are skipped when popped.
+        with self._lock:
+            if job.started or job.cancelled or job.priority == priority:
+                return
+            job.priority = priority
+            heapq.heappush(self._queue,
+                           (priority, next(self._sequence), job))
+            self._queued.notify()
+
+    def cancel(self, job):
+        # A job already running is finished, but not delivered.
+        with self._lock:
+            job.cancelled = True
+
+    def wait(self, jobs):
+        # Block until the jobs are finished, and deliver them.
+        with self._lock:
+            while not all(job.finished or job.cancelled for job in jobs):
+                self._finished.wait()
+        for job in jobs:
+            self._deliver(job)
+
+    def _worker_thread(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    self._queued.wait()
+                entry = heapq.heappop(self._queue)
+                priority, job = entry[0], entry[2]
+                if job.started or job.cancelled or priority != job.priority:
+                    continue
+                job.started = True
+
+            try:
+                job.result = job.function(*job.args)
+            except Exception:
+                logging.exception('Tile job failed')
+
+            with self._lock:
+                job.finished = True
+                self._finished.notify_all()
+            GObject.idle_add(self.__job_finished_idle_cb, job)
+
+    def __job_finished_idle_cb(self, job):
+        self._deliver(job)
+        return False
 
-    ctx_surface.set_source_surface(surface, 0, 0)
-    ctx_surface.paint()
+    def _deliver(self, job):
+        if job.delivered or job.cancelled:
+            return
+        job.delivered = True
+        job.done_cb(job, *job.user_data)
+
+
+def _get_processor_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+tile_pool = TilePool(_get_processor_count())
+
+
+class TileStore(object):
+    """
+    Multi-resolution tile pyramid for an image.
+
+    Level 0 is the decoded pixbuf, every following level halves its
+    dimensions until the whole level fits in a single tile, and is
+    box filtered from the previous one.  Levels are scaled and tiles
+    converted to cairo surfaces only when they are first needed,
+    levels in the background once the image is decoded.  Scaled
+    levels and converted tiles are kept in caches charged to the
+    memory budget, so the cairo memory in use follows the size of the
+    screen rather than the size of the image, and no single surface
+    ever goes past cairo's 32767 pixels limit.  The decoded pixbuf is
+    pinned in the budget until clear() is called, unless the owner of
+    the store accounts for it.  So is the level painted, held out of
+    its cache so the tiles converted from it can't evict it.
+
+    Tiles may also be converted by the tile pool, see
+    request_tiles().
+
+    The pixbuf may have been decoded at a reduced size, width and
+    height are then the size of the original image, which is the
+    coordinate space used by the view.  It may also still be filled
+    by a progressive decode, in which case only the area reported
+    through update_area() is painted until finish() is called.
+    """
+
+    def __init__(self, pixbuf, width=None, height=None, complete=True,
+                 pin=True):
+        self.width = width or pixbuf.get_width()
+        self.height = height or pixbuf.get_height()
+
+        self._complete = complete
+        self._updated_area = None
+
+        self._sizes = [(pixbuf.get_width(), pixbuf.get_height())]
+        width, height = self._sizes[0]
+        while width > TILE_SIZE or height > TILE_SIZE:
+            width = max(1, width // 2)
+            height = max(1, height // 2)
+            self._sizes.append((width, height))
+
+        self._pixbuf = pixbuf
+        self._levels = PixelCache(memory_budget)
+        self._tiles = PixelCache(memory_budget)
+        self._building = False
+        self._held = None
+        self._jobs = {}
+        self._generation = 0
+        if pin:
+            memory_budget.pin(self, _get_size(pixbuf))
+
+    def get_level_count(self):
+        return len(self._sizes)
+
+    def get_level_size(self, level):
+        return self._sizes[level]
+
+    def get_level_scale(self, level):
+        width, height = self.get_level_size(level)
+        return (width * 1.0 / self.width, height * 1.0 / self.height)
+
+    def get_level_for_scale(self, scale):
+        # Pick the smallest level with at least the resolution of the
+        # requested scale, so it is never upscaled, and downscaled by
+        # less than half.
+        base_scale = self.get_level_scale(0)[0]
+        if scale >= base_scale:
+            return 0
+        level = int(math.floor(math.log(base_scale / scale, 2) + 1e-6))
+        return min(level, len(self._sizes) - 1)
+
+    def get_ready_level(self, level, ready_cb):
+        # Return the level to paint in place of the given one: the
+        # level itself if it is scaled already, otherwise the closest
+        # coarser level scaled, or failing that the closest finer
+        # one, while the levels are built in the background.
+        # ready_cb is then called from the main loop.  The levels of
+        # an image still being decoded are only scaled when painted.
+        if not self._complete:
+            return level
+
+        if not self._has_level(level):
+            self.build_levels(ready_cb)
+            ready = level + 1
+            while ready <= self._get_max_level() and \
+                    not self._has_level(ready):
+                ready += 1
+            if ready > self._get_max_level():
+                ready = level - 1
+                while not self._has_level(ready):
+                    ready -= 1
+            level = ready
+
+        self._hold_level(level)
+        return level
+
+    def build_levels(self, ready_cb, *user_data):
+        # Scale the missing levels in a worker thread, from the one
+        # above the first missing, and call ready_cb with the user
+        # data from the main loop once they are added, right away if
+        # none is missing.
+        if self._building:
+            return
+        start = 0
+        while start < self._get_max_level() and self._has_level(start + 1):
+            start += 1
+        if start == self._get_max_level():
+            ready_cb(*user_data)
+            return
+
+        self._building = True
+        thread = threading.Thread(
+            target=self._build_levels_thread,
+            args=(start, self._get_level_pixbuf(start),
+                  self._get_max_level(), self._generation, ready_cb,
+                  user_data))
+        thread.daemon = True
+        thread.start()
+
+    def _has_level(self, level):
+        return level == 0 or level in self._levels or \
+            (self._held is not None and self._held[0] == level)
+
+    def _hold_level(self, level):
+        # Move the level painted out of the cache, and the one it
+        # replaces back in.
+        if self._held is not None and self._held[0] == level:
+            return
+        if self._held is not None:
+            held_level, pixbuf = self._held
+            self._drop_held()
+            self._levels.add(held_level, pixbuf)
+        pixbuf = self._levels.get(level) if level > 0 else None
+        if pixbuf is not None:
+            self._levels.remove(level)
+            self._held = (level, pixbuf)
+            memory_budget.pin((self, 'level'), _get_size(pixbuf))
+
+    def _drop_held(self):
+        self._held = None
+        memory_budget.unpin((self, 'level'))
+
+    def is_full_resolution(self):
+        return self._sizes[0] == (self.width, self.height)
+
+    def covers_scale(self, scale):
+        # Whether level 0 has enough pixels to paint the image at
+        # that scale without upscaling it, give or take the rounding
+        # of the reduced size.
+        base_width, base_height = self._sizes[0]
+        return (scale * self.width <= base_width + 1 and
+                scale * self.height <= base_height + 1)
+
+    def get_tile_range(self, level, x, y, width, height):
+        # Return the columns and rows of the tiles intersecting the
+        # given rectangle, in level coordinates, as half-open ranges.
+        level_width, level_height = self.get_level_size(level)
+        cols = int(math.ceil(level_width * 1.0 / TILE_SIZE))
+        rows = int(math.ceil(level_height * 1.0 / TILE_SIZE))
+        first_col = max(0, int(math.floor(x / TILE_SIZE)))
+        first_row = max(0, int(math.floor(y / TILE_SIZE)))
+        last_col = min(cols, int(math.ceil((x + width) / TILE_SIZE)))
+        last_row = min(rows, int(math.ceil((y + height) / TILE_SIZE)))
+        return (range(first_col, last_col), range(first_row, last_row))
+
+    def get_tile(self, level, col, row):
+        key = (level, col, row)
+        tile = self._tiles.get(key)
+        if tile is None:
+            tile = self._render_tile(level, col, row)
+            self._tiles.add(key, tile)
+        return tile
+
+    def find_tile(self, level, col, row):
+        # Return the tile if it is cached, otherwise the cached tile
+        # of the closest coarser level covering it, with its level,
+        # or (None, None).
+        for tile_level in range(level, self._get_max_level() + 1):
+            shift = tile_level - level
+            tile = self._tiles.get((tile_level, col >> shift, row >> shift))
+            if tile is not None:
+                return tile, tile_level
+        return None, None
+
+    def request_tiles(self, level, tiles, ready_cb):
+        # Have the tiles of the level missing among the given (col,
+        # row, priority) ones rendered by the tile pool, and cancel
+        # the other pending ones.  ready_cb is called with the key of
+        # each tile as it is added.
+        wanted = set()
+        for col, row, priority in tiles:
+            key = (level, col, row)
+            wanted.add(key)
+            job = self._jobs.get(key)
+            if job is not None:
+                tile_pool.prioritize(job, priority)
+            elif key not in self._tiles:
+                function, args = self._get_tile_job(level, col, row)
+                self._jobs[key] = tile_pool.submit(
+                    function, args, priority, self.__tile_done_cb, key,
+                    self._generation, ready_cb)
+
+        for key in list(self._jobs.keys()):
+            if key not in wanted:
+                tile_pool.cancel(self._jobs.pop(key))
+
+    def wait_tiles(self, keys):
+        # Block until the pending tiles with the given keys are added.
+        tile_pool.wait([self._jobs[key] for key in keys
+                        if key in self._jobs])
+
+    def _cancel_tiles(self):
+        for job in self._jobs.values():
+            tile_pool.cancel(job)
+        self._jobs.clear()
+        self._generation += 1
+
+    def __tile_done_cb(self, job, key, generation, ready_cb):
+        # Tiles of an outdated pixbuf, or of a store no longer on
+        # screen, are dropped.
+        if self._jobs.get(key) is job:
+            del self._jobs[key]
+        if job.result is None or generation != self._generation or \
+                not self._tiles.visible:
+            return
+        self._tiles.add(key, job.result)
+        ready_cb(key)
+
+    def get_pixbuf(self):
+        return self._pixbuf
+
+    def get_caches(self):
+        return (self._levels, self._tiles)
+
+    def set_visible(self, visible):
+        # The caches of the store on screen are evicted last.
+        self._levels.visible = visible
+        self._tiles.visible = visible
+        if not visible:
+            self._cancel_tiles()
+
+    def drop_caches(self):
+        # Release the scaled levels and the tiles, which are made
+        # again when needed.
+        self._cancel_tiles()
+        self._drop_held()
+        self._levels.clear()
+        self._tiles.clear()
+
+    def clear(self):
+        # Release the memory of the store, once it is replaced.
+        self.drop_caches()
+        memory_budget.unpin(self)
+
+    def reduce(self, scale):
+        # Return a store holding only the level for the scale, with
+        # the same coordinates, to keep in place of this one while
+        # memory is short, or None if there is no smaller level.
+        level = self.get_level_for_scale(scale)
+        if level == 0 or not self._complete:
+            return None
+        return TileStore(self._get_level_pixbuf(level), self.width,
+                         self.height)
+
+    def _get_max_level(self):
+        return len(self._sizes) - 1
+
+    def _get_tile_job(self, level, col, row):
+        # Return the function rendering the tile in the tile pool,
+        # and its arguments.
+        return self._convert_tile, (self._get_level_pixbuf(level), level,
+                                    col, row)
+
+    def _render_tile(self, level, col, row):
+        function, args = self._get_tile_job(level, col, row)
+        return function(*args)
+
+    def _convert_tile(self, pixbuf, level, col, row):
+        level_width, level_height = self._sizes[level]
+        x = col * TILE_SIZE
+        y = row * TILE_SIZE
+        return _surface_from_pixbuf(_copy_pixbuf_area(
+            pixbuf, x, y, min(TILE_SIZE, level_width - x),
+            min(TILE_SIZE, level_height - y)))
+
+    def update_area(self, x, y, width, height):
+        # Part of the pixbuf was decoded, in level 0 coordinates.
+        # The tiles showing it and the scaled levels are outdated.
+        if self._updated_area is None:
+            self._updated_area = (x, y, x + width, y + height)
+        else:
+            x1, y1, x2, y2 = self._updated_area
+            self._updated_area = (min(x, x1), min(y, y1),
+                                  max(x + width, x2), max(y + height, y2))
+
+        self._cancel_tiles()
+        self._drop_held()
+        self._levels.clear()
+
+        for key in self._tiles.keys():
+            tile_level, col, row = key
+            if tile_level > 0 or \
+                    (col * TILE_SIZE < x + width and
+                     (col + 1) * TILE_SIZE > x and
+                     row * TILE_SIZE < y + height and
+                     (row + 1) * TILE_SIZE > y):
+                self._tiles.remove(key)
+
+    def finish(self):
+        self._complete = True
+        self._updated_area = None
+
+    def get_valid_rectangle(self, level):
+        # Return the area decoded so far in level coordinates, or
+        # None if the whole image is decoded.
+        if self._complete:
+            return None
+        if self._updated_area is None:
+            return (0, 0, 0, 0)
+
+        x1, y1, x2, y2 = self._updated_area
+        base_width, base_height = self._sizes[0]
+        level_width, level_height = self._sizes[level]
+        scale_x = level_width * 1.0 / base_width
+        scale_y = level_height * 1.0 / base_height
+        return (x1 * scale_x, y1 * scale_y,
+                (x2 - x1) * scale_x, (y2 - y1) * scale_y)
+
+    def _get_level_pixbuf(self, level):
+        if level == 0:
+            return self._pixbuf
+        if self._held is not None and self._held[0] == level:
+            return self._held[1]
+
+        pixbuf = self._levels.get(level)
+        if pixbuf is None:
+            pixbuf = self._scale_level(level,
+                                       self._get_level_pixbuf(level - 1))
+            self._levels.add(level, pixbuf)
+        return pixbuf
+
+    def _scale_level(self, level, previous_pixbuf):
+        # Halving with GdkPixbuf's bilinear filter averages every 2x2
+        # block of the previous level, a box filter.
+        width, height = self._sizes[level]
+        with perftrace.span('scale_level', level=level):
+            return previous_pixbuf.scale_simple(
+                width, height, GdkPixbuf.InterpType.BILINEAR)
+
+    def _build_levels_thread(self, start, pixbuf, level, generation,
+                             ready_cb, user_data):
+        # This runs in a worker thread, scaling the levels after start
+        # down to the given one.
+        pixbufs = []
+        for index in range(start + 1, level + 1):
+            pixbuf = self._scale_level(index, pixbuf)
+            pixbufs.append(pixbuf)
+        GObject.idle_add(self.__levels_built_idle_cb, start, pixbufs,
+                         generation, ready_cb, user_data)
+
+    def __levels_built_idle_cb(self, start, pixbufs, generation,
+                               ready_cb, user_data):
+        # Levels built for an outdated pixbuf, or for a store hidden
+        # or cleared meanwhile, are dropped.
+        self._building = False
+        if generation == self._generation:
+            for index, pixbuf in enumerate(pixbufs):
+                if not self._has_level(start + 1 + index):
+                    self._levels.add(start + 1 + index, pixbuf)
+            ready_cb(*user_data)
+        return False
+
+
+class VectorTileStore(TileStore):
+    """
+    Tile pyramid for an SVG image, rendered by librsvg.
+
+    Levels are zoom buckets, powers of two of the intrinsic size of
+    the image, with negative levels to zoom in.  The level used is
+    the closest one at or above the displayed zoom, so tiles are
+    rendered sharp at any zoom, and only the tiles in view are ever
+    rendered, whatever the size of the image.
+    """
+
+    MIN_LEVEL = -int(math.ceil(math.log(ZOOM_MAX, 2)))
+
+    def __init__(self, handle):
+        dimensions = handle.get_dimensions()
+        self.width = max(1, dimensions.width)
+        self.height = max(1, dimensions.height)
+
+        self._handle = handle
+        self._complete = True
+        self._updated_area = None
+        self._levels = PixelCache(memory_budget)
+        self._tiles = PixelCache(memory_budget)
+        self._held = None
+        self._jobs = {}
+        self._generation = 0
+
+        # Tiles are rendered by several threads, but a librsvg handle
+        # can only render from one at a time.
+        self._render_lock = threading.Lock()
+
+        self._max_level = 0
+        width, height = self.width, self.height
+        while width > TILE_SIZE or height > TILE_SIZE:
+            width = max(1, width // 2)
+            height = max(1, height // 2)
+            self._max_level += 1
+
+    def get_level_count(self):
+        return self._max_level - self.MIN_LEVEL + 1
+
+    def get_level_size(self, level):
+        scale = 2.0 ** -level
+        return (max(1, int(math.ceil(self.width * scale))),
+                max(1, int(math.ceil(self.height * scale))))
+
+    def get_level_for_scale(self, scale):
+        level = int(math.floor(math.log(1.0 / scale, 2)))
+        return max(self.MIN_LEVEL, min(level, self._max_level))
+
+    def get_ready_level(self, level, ready_cb):
+        # Tiles are rendered straight from the vector image.
+        return level
+
+    def reduce(self, scale):
+        return None
+
+    def is_full_resolution(self):
+        return True
+
+    def covers_scale(self, scale):
+        return True
+
+    def get_pixbuf(self):
+        with self._render_lock:
+            return self._handle.get_pixbuf()
+
+    def _get_max_level(self):
+        return self._max_level
+
+    def _get_tile_job(self, level, col, row):
+        return self._render_tile, (level, col, row)
+
+    def _render_tile(self, level, col, row):
+        level_width, level_height = self.get_level_size(level)
+        x = col * TILE_SIZE
+        y = row * TILE_SIZE
+        tile = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                  min(TILE_SIZE, level_width - x),
+                                  min(TILE_SIZE, level_height - y))
+
+        ctx = cairo.Context(tile)
+        ctx.translate(-x, -y)
+        ctx.scale(*self.get_level_scale(level))
+        with self._render_lock, \
+                perftrace.span('render_svg', level=level):
+            self._handle.render_cairo(ctx)
+        return tile
+
+
+class _Animation(object):
+    """
+    Frames of an animated image.
+
+    The frame timings are read once, when the animation is created
+    in the decoding thread.  Frames are composited by GdkPixbuf and
+    converted to tile stores when they are first shown, then kept in
+    a cache charged to the memory budget.  An evicted frame is
+    composited again from a fresh iterator when needed.
+    """
+
+    # GdkPixbuf doesn't show frames for less than this, in ms.
+    MIN_DELAY = 20
+
+    def __init__(self, animation, frame_count):
+        self._animation = animation
+        self._frames = PixelCache(memory_budget, self.__release_frame_cb)
+
+        # Step through the frames with a synthetic clock, to learn
+        # how long each of them is shown.
+        self.delays = []
+        self._starts = []
+        start = 0
+        iterator = animation.get_iter(_time_val(0))
+        for index in range(frame_count):
+            delay = iterator.get_delay_time()
+            if delay < 0:
+                # The last frame of an animation that doesn't loop.
+                break
+            delay = max(delay, self.MIN_DELAY)
+            self.delays.append(delay)
+            self._starts.append(start)
+            start += delay
+            iterator.advance(_time_val(start))
+
+    def get_frame(self, index):
+        tile_store = self._frames.get(index)
+        if tile_store is None:
+            iterator = self._animation.get_iter(_time_val(0))
+            iterator.advance(_time_val(self._starts[index]))
+            pixbuf = iterator.get_pixbuf().copy()
+            tile_store = TileStore(pixbuf, pin=False)
+            self._frames.add(index, tile_store, _get_size(pixbuf))
+        return tile_store
+
+    def set_visible(self, visible):
+        self._frames.visible = visible
+
+    def clear(self):
+        self._frames.clear()
+
+    def trim(self, index):
+        # Release the frames but the one at the index, which may be
+        # on screen.
+        for key in self._frames.keys():
+            if key != index:
+                self._frames.remove(key)
+
+    def __release_frame_cb(self, tile_store):
+        tile_store.clear()
+
+
+class _StreamDecoder(object):
+    """
+    Decode an image from a stream in a worker thread.
+
+    The stream, any object with read() and close() methods, is fed
+    in chunks to a PixbufLoader.  If a size is given and the image is
+    larger, it is decoded straight to that size, which lets the JPEG
+    loader skip most of the work.  The callbacks are called from the
+    main loop: prepared_cb with the tile store once allocated,
+    updated_cb with the area decoded since the previous call, at most
+    every UPDATE_INTERVAL milliseconds, and finished_cb at the end.
+
+    GIF files are kept in memory while decoding, to count their
+    frames, and are never decoded at a reduced size, which would
+    drop their animation.  SVG files are read whole and rendered
+    by librsvg, if available.
+
+    The EXIF header of JPEG files is read first: the orientation
+    is reported with the tile store, and if the file embeds a
+    thumbnail, it is decoded and reported as the tile store first,
+    at the full image size.  The decoded image then replaces it
+    when finished.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    UPDATE_INTERVAL = 100
+
+    def __init__(self, stream, size, finished_cb, prepared_cb=None,
+                 updated_cb=None):
+        self._stream = stream
+        self._size = size
+        self._finished_cb = finished_cb
+        self._prepared_cb = prepared_cb
+        self._updated_cb = updated_cb
+
+        self.tile_store = None
+        self.animation = None
+        self.orientation = exif.ORIENTATIONS[1]
+        self.failed = False
+        self._preview = None
+        self._image_size = None
+        self._cancelled = False
+        self._gif_data = None
+
+        # Area decoded and not reported yet, shared with the worker.
+        self._lock = threading.Lock()
+        self._pending_area = None
+        self._update_scheduled = False
+
+    def start(self):
+        thread = threading.Thread(target=self._decode_thread)
+        thread.daemon = True
+        thread.start()
+
+    def cancel(self):
+        self._cancelled = True
+
+    def _decode_thread(self):
+        # This runs in the worker thread, so it must not touch the
+        # widget.  Results are handed to the main loop.
+        try:
+            try:
+                with perftrace.span('decode', size=self._size):
+                    data = self._stream.read(self.CHUNK_SIZE)
+                    if RSVG_AVAILABLE and _is_svg(data):
+                        self._decode_svg(data)
+                    else:
+                        self._decode_pixbuf(data)
+            finally:
+                self._stream.close()
+        except (GLib.Error, IOError) as error:
+            if not self._cancelled:
+                logging.error('Could not decode image: %s', error)
+            self.failed = True
+
+        if not self._cancelled:
+            GObject.idle_add(self.__finished_idle_cb)
+        else:
+            # Nobody will release the pixels decoded for nothing.
+            for tile_store in (self._preview, self.tile_store):
+                if tile_store is not None:
+                    memory_budget.unpin(tile_store)
+
+    def _decode_svg(self, data):
+        chunks = [data]
+        while not self._cancelled and data:
+            data = self._stream.read(self.CHUNK_SIZE)
+            chunks.append(data)
+        if self._cancelled:
+            return
+
+        handle = Rsvg.Handle.new_from_data(b''.join(chunks))
+        self.tile_store = VectorTileStore(handle)
+        if self._prepared_cb is not None:
+            GObject.idle_add(self.__prepared_idle_cb, self.tile_store)
+
+    def _decode_pixbuf(self, data):
+        loader = GdkPixbuf.PixbufLoader()
+        loader.connect('size-prepared', self.__size_prepared_cb)
+        loader.connect('area-prepared', self.__area_prepared_cb)
+        if self._updated_cb is not None:
+            loader.connect('area-updated', self.__area_updated_cb)
+
+        if data[:3] == b'GIF':
+            self._gif_data = []
+        elif exif.is_jpeg(data):
+            data = self._read_jpeg_header(data)
+        while not self._cancelled and data:
+            if self._gif_data is not None:
+                self._gif_data.append(data)
+            loader.write(data)
+            data = self._stream.read(self.CHUNK_SIZE)
+        loader.close()
+
+        animation = loader.get_animation()
+        if self._gif_data is not None and animation is not None and \
+                not animation.is_static_image():
+            frame_count = _count_gif_frames(b''.join(self._gif_data))
+            if frame_count > 1:
+                self.animation = _Animation(animation, frame_count)
+        self._gif_data = None
+
+    def _read_jpeg_header(self, data):
+        # The EXIF segment is at most 64k, but may come after others.
+        if len(data) == self.CHUNK_SIZE:
+            data += self._stream.read(self.CHUNK_SIZE)
+
+        size, self.orientation, thumbnail = exif.parse_jpeg(data)
+        if size is None or thumbnail is None or self._prepared_cb is None:
+            return data
+
+        try:
+            loader = GdkPixbuf.PixbufLoader()
+            loader.write(thumbnail)
+            loader.close()
+        except GLib.Error as error:
+            logging.debug('Could not decode the thumbnail: %s', error)
+            return data
+
+        # Thumbnails are often letterboxed to 4:3, drop the bars.
+        pixbuf = loader.get_pixbuf()
+        width, height = size
+        thumbnail_width = pixbuf.get_width()
+        thumbnail_height = pixbuf.get_height()
+        if width * thumbnail_height > height * thumbnail_width:
+            crop_height = max(1, thumbnail_width * height // width)
+            pixbuf = _copy_pixbuf_area(
+                pixbuf, 0, (thumbnail_height - crop_height) // 2,
+                thumbnail_width, crop_height)
+        elif width * thumbnail_height < height * thumbnail_width:
+            crop_width = max(1, thumbnail_height * width // height)
+            pixbuf = _copy_pixbuf_area(
+                pixbuf, (thumbnail_width - crop_width) // 2, 0,
+                crop_width, thumbnail_height)
+
+        self.tile_store = TileStore(pixbuf, width, height)
+        self._preview = self.tile_store
+        GObject.idle_add(self.__prepared_idle_cb, self.tile_store)
+        return data
+
+    def __size_prepared_cb(self, loader, width, height):
+        self._image_size = (width, height)
+        if self._size is None or self._gif_data is not None:
+            return
+
+        ratio = min(self._size[0] * 1.0 / width,
+                    self._size[1] * 1.0 / height)
+        if ratio < 1:
+            loader.set_size(max(1, int(width * ratio)),
+                            max(1, int(height * ratio)))
+
+    def __area_prepared_cb(self, loader):
+        width, height = self._image_size
+        self.tile_store = TileStore(loader.get_pixbuf(), width, height,
+                                    complete=False)
+        if self._prepared_cb is not None and self._preview is None:
+            GObject.idle_add(self.__prepared_idle_cb, self.tile_store)
+
+    def __area_updated_cb(self, loader, x, y, width, height):
+        with self._lock:
+            if self._pending_area is None:
+                self._pending_area = (x, y, x + width, y + height)
+            else:
+                x1, y1, x2, y2 = self._pending_area
+                self._pending_area = (min(x, x1), min(y, y1),
+                                      max(x + width, x2),
+                                      max(y + height, y2))
+            if self._update_scheduled:
+                return
+            self._update_scheduled = True
+
+        GObject.timeout_add(self.UPDATE_INTERVAL, self.__update_timeout_cb)
+
+    def __update_timeout_cb(self):
+        with self._lock:
+            area = self._pending_area
+            self._pending_area = None
+            self._update_scheduled = False
+
+        if area is not None and not self._cancelled:
+            x1, y1, x2, y2 = area
+            self._updated_cb(self, (x1, y1, x2 - x1, y2 - y1))
+        return False
+
+    def __prepared_idle_cb(self, tile_store):
+        if not self._cancelled:
+            self._prepared_cb(self, tile_store)
+        return False
+
+    def __finished_idle_cb(self):
+        if self._cancelled:
+            return False
+
+        # Report what is left before finishing.
+        if self._updated_cb is not None:
+            self.__update_timeout_cb()
+
+        self._finished_cb(self)
+        return False
+
+
+class QualityScheduler(object):
+    """
+    Pick the rendering quality of the next frame from measured paint
+    times.
+
+    While the view is interacting, frames are painted with the best
+    filter whose cost, estimated from the previous frames, fits in
+    FRAME_BUDGET.  When even FILTER_NEAREST doesn't fit, the image is
+    painted from a coarser pyramid level.  Once no interaction
+    happened for a few frame times, the view is painted at the best
+    quality.  Times are in milliseconds.
+    """
 
-    return new_surface
+    FRAME_BUDGET = 1000.0 / 60
+    FILTERS = (cairo.FILTER_NEAREST, cairo.FILTER_FAST, cairo.FILTER_GOOD)
+    MAX_LEVEL_BIAS = 2
+
+    IDLE_FRAMES = 4
+    MIN_IDLE_DELAY = 50
+    MAX_IDLE_DELAY = 500
+
+    # Weight of the last measure in the running averages.
+    SMOOTHING = 0.3
+
+    def __init__(self):
+        self._index = 0
+        self._level_bias = 0
+        self._frame_time = None
+
+        # Measured cost of each filter, in ms per megapixel.
+        self._costs = {}
+
+    def get_quality(self):
+        # The filter and the number of levels to step down the
+        # pyramid, for an interactive frame.
+        return self.FILTERS[self._index], self._level_bias
+
+    def get_idle_delay(self):
+        # Time without interaction after which the view is painted
+        # at the best quality.
+        if self._frame_time is None:
+            return self.MIN_IDLE_DELAY
+        delay = self.IDLE_FRAMES * self._frame_time
+        return int(min(self.MAX_IDLE_DELAY, max(self.MIN_IDLE_DELAY, delay)))
+
+    def record(self, tile_filter, pixels, duration, interacting):
+        # Account for a painted frame, which rendered the given
+        # number of pixels with the filter.
+        if pixels > 0:
+            self._costs[tile_filter] = self._average(
+                self._costs.get(tile_filter), duration * 1e6 / pixels)
+        if not interacting:
+            return
+
+        self._frame_time = self._average(self._frame_time, duration)
+        if duration > self.FRAME_BUDGET:
+            if self._index > 0:
+                self._index -= 1
+            elif self._level_bias < self.MAX_LEVEL_BIAS:
+                self._level_bias += 1
+        elif duration < self.FRAME_BUDGET / 2:
+            # Upgrade with some margin, so the quality doesn't keep
+            # going back and forth, which renders whole frames.
+            if self._level_bias > 0:
+                self._level_bias -= 1
+            elif self._index < len(self.FILTERS) - 1 and \
+                    self._estimate(self._index + 1, pixels, duration) < \
+                    self.FRAME_BUDGET / 2:
+                self._index += 1
+
+    def _estimate(self, index, pixels, duration):
+        # Time to render the pixels with the filter at that index.
+        # Unmeasured filters are tried if twice the last time fits.
+        cost = self._costs.get(self.FILTERS[index])
+        if cost is None:
+            return duration * 2
+        return cost * pixels / 1e6
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return average + (value - average) * self.SMOOTHING
 
 
 class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
@@ -76,34 +1457,788 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
                         GObject.PARAM_READWRITE),
     }
 
+    __gsignals__ = {
+        # Emitted once the image set with set_file_location() has
+        # been decoded and is being displayed.
+        'image-loaded': (GObject.SignalFlags.RUN_FIRST, None, ([])),
+    }
+
     def __init__(self):
         Gtk.DrawingArea.__init__(self)
 
         self._file_location = None
-        self._surface = None
+        self._tile_store = None
         self._zoom = None
         self._target_point = None
         self._anchor_point = None
 
+        # Images are decoded in a worker thread, and painted while
+        # they are decoded.  The zoom set before the image size is
+        # known is applied once it is.
+        self._decoder = None
+        self._loading = False
+        self._pending_zoom = None
+
+        # The image is first decoded at the size of the view, the
+        # full resolution is only decoded when zooming past it.
+        self._full_decoder = None
+
+        # Offsets of the directories of the pages of a multi-page
+        # TIFF file, and the page shown.  The pages next to it are
+        # decoded ahead at the size of the view, and kept until
+        # another page is shown, so only a few pages are ever in
+        # memory.
+        self._pages = None
+        self._page = 0
+        self._page_cache = {}
+        self._page_decoders = {}
+
+        # Animations are played on the frame clock, while the widget
+        # is mapped.  The deadline is the frame time, in ms, at which
+        # the next frame is due.
+        self._animation = None
+        self._animation_frame = 0
+        self._animation_deadline = None
+        self._tick_id = None
+
+        # Rotation of the image in clockwise quarter turns, after
+        # mirroring it horizontally if mirrored, as EXIF data may
+        # ask.  It is only applied when painting, the pixels are
+        # never rotated.
+        self._orientation = 0
+        self._mirrored = False
+
+        # Tiles already scaled to the displayed zoom, so steady
+        # redraws are 1:1 copies instead of resampling the image.
+        self._scaled_tiles = PixelCache(memory_budget)
+        self._scaled_tiles.visible = True
+
+        # Keys of the tiles painted from a coarser level in the frame,
+        # while the tile pool renders them.
+        self._fallback_tiles = set()
+
+        # Tiles are uploaded once to surfaces similar to the window,
+        # and kept there, so frames are rendered in the display
+        # server.  Scaled tiles are kept uploaded too.  Device
+        # surfaces belong to a screen, they are dropped when the
+        # widget moves to another one.
+        self._device_surfaces = True
+        self._device_tiles = PixelCache(memory_budget)
+        self._device_tiles.visible = True
+
+        # The last rendered frame, with the view matrix and the
+        # rendering state it was rendered with.  When only the view
+        # translation changes, the frame is shifted and only the
+        # uncovered strips are rendered.  The spare frame is the
+        # other buffer of the pair.
+        self._frame = None
+        self._spare_frame = None
+        self._frame_size = None
+        self._frame_matrix = None
+        self._frame_state = None
+
         self._in_dragtouch = False
         self._in_zoomtouch = False
         self._zoomtouch_scale = 1
-
+        self._last_level = None
+
+        # Recent (time, x, y) samples of the drag, and the velocity
+        # of the target point while it moves on after the drag.
+        self._drag_samples = collections.deque()
+        self._kinetic_velocity = None
+        self._kinetic_time = None
+        self._kinetic_moved = None
+
+        # Zoom animation from the zoom it started at to the target
+        # zoom, and the frame time, in ms, it started at.
+        self._zoom_animated = True
+        self._zoom_from = None
+        self._zoom_target = None
+        self._zoom_start_time = None
+
+        # Paint times decide the quality of interactive frames, and
+        # how long to wait before painting at the best quality.
+        self._quality = QualityScheduler()
         self._in_scrolling = False
         self._scrolling_hid = None
         self._hadj = None
         self._vadj = None
         self._hadj_value_changed_hid = None
         self._vadj_value_changed_hid = None
+        self._updating_adjustments = False
+
+        # Input received since the last frame, applied at once on the
+        # next frame clock tick: the latest drag target point, the
+        # latest pinch center and scale, and whether each adjustment
+        # was scrolled.
+        self._pending_target = None
+        self._pending_zoomtouch = None
+        self._pending_scroll = [False, False]
+
+        # While the view isn't seen, its memory is trimmed, and the
+        # time restore_memory() was called is kept until the next
+        # frame is painted.
+        self._trimmed = False
+        self._restore_time = None
 
         self.connect('draw', self.__draw_cb)
+        self.connect('map', self.__map_cb)
+        self.connect('unmap', self.__unmap_cb)
+        self.connect('screen-changed', self.__screen_changed_cb)
 
     def set_file_location(self, file_location):
-        self._surface = None
-        self._zoom = None
         self._file_location = file_location
+        self._clear_pages()
+        with open(file_location, 'rb') as image_file:
+            if tiff.is_tiff(image_file.read(4)):
+                image_file.seek(0)
+                pages = tiff.read_page_offsets(image_file)
+                if len(pages) > 1:
+                    self._pages = pages
+        self._load(self._open_file(self._page), self._get_decode_size())
+
+    def load_stream(self, stream):
+        # Load the image from any object with read() and close()
+        # methods.  As it can only be read once, the image is
+        # decoded at full resolution.
+        self._file_location = None
+        self._clear_pages()
+        self._load(stream, None)
+
+    def _get_decode_size(self):
+        if self.get_realized():
+            alloc = self.get_allocation()
+            return (alloc.width, alloc.height)
+        return (Gdk.Screen.width(), Gdk.Screen.height())
+
+    def _open_file(self, page):
+        if self._pages is None:
+            return open(self._file_location, 'rb')
+        return tiff.PageStream(self._file_location, self._pages[page])
+
+    def get_page_count(self):
+        if self._pages is None:
+            return 1
+        return len(self._pages)
+
+    def get_page(self):
+        return self._page
+
+    def set_page(self, page):
+        # Show another page of a multi-page TIFF file.  The page left
+        # is kept at the size of the view, as it is next to the new
+        # one.
+        if self._pages is None or page == self._page or \
+                not 0 <= page < len(self._pages):
+            return
+
+        if self._full_decoder is not None:
+            self._full_decoder.cancel()
+            self._full_decoder = None
+        if self._decoder is None and self._animation is None and \
+                not self._loading and self._tile_store is not None:
+            tile_store = self._tile_store.reduce(self._get_fit_scale())
+            self._page_cache[self._page] = tile_store or self._tile_store
+
+        self._page = page
+        tile_store = self._page_cache.pop(page, None)
+        if tile_store is not None:
+            self._show_page(tile_store)
+        elif page in self._page_decoders:
+            # It is shown once decoded ahead, the page left is
+            # painted meanwhile.
+            if self._decoder is not None:
+                self._decoder.cancel()
+                self._decoder = None
+            self._loading = True
+            self._pending_zoom = None
+        else:
+            self._load(self._open_file(page), self._get_decode_size())
+
+    def _show_page(self, tile_store):
+        for decoder in (self._decoder, self._full_decoder):
+            if decoder is not None:
+                decoder.cancel()
+        self._decoder = None
+        self._full_decoder = None
+        self._stop_kinetic()
+        self._stop_zoom_animation()
+
+        self._loading = False
+        self._release_image()
+        self._set_tile_store(tile_store)
+        self._orientation, self._mirrored = exif.ORIENTATIONS[1]
+        self._zoom = self._pending_zoom
+        self._pending_zoom = None
+        self._target_point = None
+        self._anchor_point = None
+        if self._zoom is None and self.get_realized():
+            self.zoom_to_fit()
+        self.queue_draw()
+
+        self._prefetch_pages()
+        self.emit('image-loaded')
+
+    def _prefetch_pages(self):
+        # Decode the pages next to the one shown, and drop the others.
+        neighbours = set([self._page - 1, self._page + 1])
+        for page in list(self._page_cache.keys()):
+            if page not in neighbours:
+                self._page_cache.pop(page).clear()
+        for page in list(self._page_decoders.keys()):
+            if page not in neighbours and page != self._page:
+                self._page_decoders.pop(page).cancel()
+
+        for page in sorted(neighbours):
+            if 0 <= page < len(self._pages) and \
+                    page not in self._page_cache and \
+                    page not in self._page_decoders:
+                decoder = _StreamDecoder(self._open_file(page),
+                                         self._get_decode_size(),
+                                         self.__page_decoder_finished_cb)
+                self._page_decoders[page] = decoder
+                decoder.start()
+
+    def __page_decoder_finished_cb(self, decoder):
+        pages = [page for page, page_decoder in self._page_decoders.items()
+                 if page_decoder is decoder]
+        if not pages:
+            return
+        page = pages[0]
+        del self._page_decoders[page]
+
+        # A page that couldn't be decoded ahead is decoded again the
+        # usual way if it is awaited, to report the error.
+        if decoder.tile_store is None or decoder.failed:
+            if decoder.tile_store is not None:
+                decoder.tile_store.clear()
+            if page == self._page:
+                self._loading = False
+                self._load(self._open_file(page), self._get_decode_size())
+            return
+
+        decoder.tile_store.finish()
+        if page == self._page:
+            self._show_page(decoder.tile_store)
+        else:
+            self._page_cache[page] = decoder.tile_store
+
+    def _clear_pages(self):
+        for tile_store in self._page_cache.values():
+            if tile_store is not self._tile_store:
+                tile_store.clear()
+        for decoder in self._page_decoders.values():
+            decoder.cancel()
+        self._page_cache = {}
+        self._page_decoders = {}
+        self._pages = None
+        self._page = 0
+
+    def _load(self, stream, size):
+        # The previous image, if any, keeps being painted until the
+        # new one starts to be decoded.
+        for decoder in (self._decoder, self._full_decoder):
+            if decoder is not None:
+                decoder.cancel()
+        self._full_decoder = None
+        self._stop_kinetic()
+        self._stop_zoom_animation()
+
+        self._loading = True
+        self._pending_zoom = None
+        self._trimmed = False
+        self._decoder = _StreamDecoder(stream, size,
+                                       self.__decoder_finished_cb,
+                                       self.__decoder_prepared_cb,
+                                       self.__decoder_updated_cb)
+        self._decoder.start()
+
+    def _decode_full_resolution(self):
+        if self._decoder is not None or self._full_decoder is not None or \
+                self._loading or self._file_location is None or \
+                self._tile_store.is_full_resolution():
+            return
+
+        self._full_decoder = _StreamDecoder(
+            self._open_file(self._page), None,
+            self.__full_decoder_finished_cb)
+        self._full_decoder.start()
+
+    def __decoder_prepared_cb(self, decoder, tile_store):
+        if decoder is not self._decoder:
+            return
+
+        # Photos are shown upright right away, the orientation is
+        # only a part of the view matrix.
+        self._loading = False
+        self._release_image()
+        self._set_tile_store(tile_store)
+        self._orientation, self._mirrored = decoder.orientation
+        self._zoom = self._pending_zoom
+        self._pending_zoom = None
+        self._target_point = None
+        self._anchor_point = None
+
+        # Without an allocation the zoom is computed on first draw.
+        if self._zoom is None and self.get_realized():
+            self.zoom_to_fit()
+
         self.queue_draw()
 
+    def __decoder_updated_cb(self, decoder, area):
+        if decoder.tile_store is not self._tile_store:
+            return
+
+        self._tile_store.update_area(*area)
+        self._invalidate_rendering()
+        self.queue_draw()
+
+    def __decoder_finished_cb(self, decoder):
+        if decoder is not self._decoder:
+            return
+
+        self._decoder = None
+        self._loading = False
+        if decoder.tile_store is None:
+            return
+
+        # A failed decode leaves what could be decoded on screen.
+        # Otherwise the decoded image replaces the thumbnail shown
+        # meanwhile, if any, with the same coordinates.
+        if decoder.failed:
+            if decoder.tile_store is not self._tile_store:
+                decoder.tile_store.clear()
+        else:
+            decoder.tile_store.finish()
+            if decoder.tile_store is not self._tile_store:
+                self._tile_store.clear()
+                self._set_tile_store(decoder.tile_store)
+            else:
+                self._invalidate_rendering()
+            self.queue_draw()
+
+        # Animations are painted from their own frames, which are
+        # charged to the memory budget as they are composited.
+        if decoder.animation is not None:
+            self._animation = decoder.animation
+            self._animation.set_visible(True)
+            self._animation_frame = 0
+            self._animation_deadline = None
+            self._tile_store.clear()
+            self._set_tile_store(self._animation.get_frame(0))
+            self._ensure_tick()
+
+        if self._pages is not None and not decoder.failed:
+            self._prefetch_pages()
+        self.emit('image-loaded')
+
+    def __full_decoder_finished_cb(self, decoder):
+        if decoder is not self._full_decoder:
+            return
+
+        if decoder.tile_store is None:
+            self._full_decoder = None
+            return
+        if decoder.failed:
+            self._full_decoder = None
+            decoder.tile_store.clear()
+            return
+
+        # The reduced image keeps being painted until the levels of
+        # the full resolution one are scaled, in the background, so
+        # painting doesn't convert tiles from a much larger level.
+        # They are about to be on screen, so evicted last.
+        decoder.tile_store.finish()
+        decoder.tile_store.set_visible(True)
+        decoder.tile_store.build_levels(self.__full_levels_built_cb,
+                                        decoder)
+
+    def __full_levels_built_cb(self, decoder):
+        # The full decode may have been cancelled meanwhile.
+        if decoder is not self._full_decoder:
+            decoder.tile_store.clear()
+            return
+
+        # The view state doesn't change, the full resolution image
+        # has the same coordinates as the reduced one.
+        self._full_decoder = None
+        self._tile_store.clear()
+        self._set_tile_store(decoder.tile_store)
+        self.queue_draw()
+
+    def _ensure_tick(self):
+        # Frame clock updates only run while the widget is mapped.
+        if self._tick_id is None and self.get_mapped():
+            self._tick_id = self.add_tick_callback(self.__tick_cb)
+
+    def __map_cb(self, widget):
+        # The tick is removed on unmap, even with a zoom animation or
+        # input still pending, which it finishes.
+        if self._animation is not None or \
+                self._zoom_target is not None or \
+                self._pending_target is not None or \
+                self._pending_zoomtouch is not None or \
+                any(self._pending_scroll):
+            self._ensure_tick()
+
+    def __unmap_cb(self, widget):
+        if self._tick_id is not None:
+            self.remove_tick_callback(self._tick_id)
+            self._tick_id = None
+        # Resume where it was paused.
+        self._animation_deadline = None
+        self._stop_kinetic()
+
+    def __screen_changed_cb(self, widget, previous_screen):
+        self._drop_device_surfaces()
+
+    def _drop_device_surfaces(self):
+        # Drop the surfaces similar to the window, the tiles and the
+        # frames, to be made again for the new screen.
+        self._invalidate_rendering()
+        self._frame = None
+        self._spare_frame = None
+        self._frame_size = None
+        memory_budget.unpin(self)
+        self.queue_draw()
+
+    def set_device_surfaces(self, device_surfaces):
+        # Whether tiles are uploaded to device surfaces, to compare
+        # with painting them from client memory.
+        self._device_surfaces = device_surfaces
+        self._drop_device_surfaces()
+
+    def set_zoom_animated(self, zoom_animated):
+        # Whether zoom steps are animated, or applied at once, to
+        # time the frame at the zoom reached.
+        self._zoom_animated = zoom_animated
+
+    def flush_input(self):
+        # Apply the input pending for the next frame clock tick now,
+        # so the next frame painted shows it.
+        self._apply_input()
+
+    def __tick_cb(self, widget, frame_clock):
+        # Everything that moves is advanced here, so there is at most
+        # one draw per frame.
+        frame_time = frame_clock.get_frame_time() / 1000.0
+        self._apply_input()
+        animating = self._advance_animation(frame_time)
+        panning = self._advance_kinetic(frame_time)
+        zooming = self._advance_zoom(frame_time)
+        if not animating and not panning and not zooming:
+            self._tick_id = None
+            return False
+        return True
+
+    def _advance_animation(self, frame_time):
+        # Show the frame due at the given frame time.  Returns
+        # whether the animation goes on.  It is paused while the
+        # memory is trimmed.
+        if self._animation is None or self._trimmed:
+            return False
+
+        delays = self._animation.delays
+        if self._animation_deadline is None:
+            self._animation_deadline = \
+                frame_time + delays[self._animation_frame]
+            return True
+
+        if frame_time < self._animation_deadline:
+            return True
+
+        # Skip the frames that were due while painting was late.
+        while frame_time >= self._animation_deadline:
+            self._animation_frame = \
+                (self._animation_frame + 1) % len(delays)
+            self._animation_deadline += delays[self._animation_frame]
+
+        self._set_tile_store(
+            self._animation.get_frame(self._animation_frame))
+        self.queue_draw()
+        return True
+
+    def _queue_input(self):
+        # Input is applied on the next tick, or right away if the
+        # widget isn't mapped and has no frame clock running.
+        self._ensure_tick()
+        if self._tick_id is None:
+            self._apply_input()
+
+    def _apply_input(self):
+        # Apply the input received since the last frame, with a single
+        # update of the adjustments and a single draw.
+        target = self._pending_target
+        zoomtouch = self._pending_zoomtouch
+        scroll_x, scroll_y = self._pending_scroll
+        self._pending_target = None
+        self._pending_zoomtouch = None
+        self._pending_scroll = [False, False]
+
+        if self._tile_store is None or self._zoom is None or \
+                self._anchor_point is None:
+            return
+
+        if zoomtouch is not None:
+            center, scale = zoomtouch
+            self._zoomtouch_scale = scale
+
+            # Set target point to the relative coordinates of this
+            # view.
+            alloc = self.get_allocation()
+            self._target_point = (center[1] - alloc.x, center[2] - alloc.y)
+
+        if target is not None:
+            self._target_point = target
+
+        if scroll_x:
+            self._scroll_horizontally()
+        if scroll_y:
+            self._scroll_vertically()
+
+        if target is not None:
+            self._update_adjustments()
+        if target is not None or zoomtouch is not None or scroll_x or \
+                scroll_y:
+            self.queue_draw()
+
+    def _animate_zoom(self, zoom):
+        # Move the zoom toward the given one over the next frames.  A
+        # running animation is retargeted from where it is.
+        if not self.get_mapped() or not self._zoom_animated:
+            self._stop_zoom_animation()
+            self._zoom = zoom
+            self._center_if_small()
+            self._update_adjustments()
+            self.queue_draw()
+            return
+
+        self._zoom_from = self._zoom
+        self._zoom_target = zoom
+        self._zoom_start_time = None
+        self._ensure_tick()
+
+    def _stop_zoom_animation(self):
+        self._zoom_from = None
+        self._zoom_target = None
+        self._zoom_start_time = None
+
+    def _advance_zoom(self, frame_time):
+        # Set the zoom for the given frame time.  Returns whether the
+        # animation goes on.
+        if self._zoom_target is None:
+            return False
+        if self._zoom_start_time is None:
+            self._zoom_start_time = frame_time
+
+        # Ease out, the zoom slows down as it reaches the target.
+        progress = min(1.0, (frame_time - self._zoom_start_time) /
+                       ZOOM_DURATION)
+        progress = 1 - (1 - progress) ** 3
+        self._zoom = self._zoom_from + \
+            (self._zoom_target - self._zoom_from) * progress
+
+        if progress >= 1:
+            # The last frame is painted at the best quality.
+            self._stop_zoom_animation()
+            self._center_if_small()
+            self._update_adjustments()
+            self.queue_draw()
+            return False
+
+        self._update_adjustments()
+        self.queue_draw()
+        return True
+
+    def _start_kinetic(self):
+        # Keep the target point moving at the speed the drag ended
+        # with, if it was fast enough.
+        now = GLib.get_monotonic_time() / 1000.0
+        samples = [sample for sample in self._drag_samples
+                   if now - sample[0] <= KINETIC_WINDOW]
+        self._drag_samples.clear()
+        if len(samples) < 2 or samples[-1][0] <= samples[0][0]:
+            return
+
+        duration = samples[-1][0] - samples[0][0]
+        velocity = ((samples[-1][1] - samples[0][1]) / duration,
+                    (samples[-1][2] - samples[0][2]) / duration)
+        if math.hypot(*velocity) < KINETIC_MIN_SPEED:
+            return
+
+        self._kinetic_velocity = velocity
+        self._kinetic_time = None
+        self._kinetic_moved = (0, 0)
+        self._ensure_tick()
+
+    def _stop_kinetic(self):
+        self._kinetic_velocity = None
+        self._kinetic_time = None
+
+    def _advance_kinetic(self, frame_time):
+        # Move the target point for the given frame time.  Returns
+        # whether it keeps moving.
+        if self._kinetic_velocity is None:
+            return False
+        if self._kinetic_time is None:
+            self._kinetic_time = frame_time
+            return True
+
+        elapsed = frame_time - self._kinetic_time
+        self._kinetic_time = frame_time
+        decay = math.exp(-elapsed / KINETIC_DECAY)
+        velocity_x, velocity_y = self._kinetic_velocity
+
+        # Distance covered while the velocity decayed, and no further
+        # than the edges of the image.
+        distance = KINETIC_DECAY * (1 - decay)
+        delta_x, velocity_x = self._clamp_kinetic(
+            0, velocity_x * distance, velocity_x * decay)
+        delta_y, velocity_y = self._clamp_kinetic(
+            1, velocity_y * distance, velocity_y * decay)
+
+        # Move by whole pixels, so the previous frame can be reused by
+        # shifting it, and keep the fractions for the next frames.
+        moved_x, moved_y = self._kinetic_moved
+        self._kinetic_moved = (moved_x + delta_x, moved_y + delta_y)
+        self._target_point = (
+            self._target_point[0] + round(moved_x + delta_x) -
+            round(moved_x),
+            self._target_point[1] + round(moved_y + delta_y) -
+            round(moved_y))
+
+        if math.hypot(velocity_x, velocity_y) < KINETIC_MIN_SPEED:
+            # Settled, paint at the best quality.
+            self._stop_kinetic()
+            self._center_if_small()
+            self._update_adjustments()
+            self.queue_draw()
+            return False
+
+        self._kinetic_velocity = (velocity_x, velocity_y)
+        self._update_adjustments()
+        self.queue_draw()
+        return True
+
+    def _clamp_kinetic(self, axis, delta, velocity):
+        # Limit the move along the axis so that the image, if larger
+        # than the view, still covers it.  The velocity drops to 0 at
+        # the edge.
+        alloc = self.get_allocation()
+        view_size = (alloc.width, alloc.height)[axis]
+        image_size = self._get_image_size()[axis] * self._zoom
+        if image_size <= view_size:
+            return 0, 0
+
+        # The left or top edge of the image may already be past its
+        # limit, after dragging, then it only may move back.
+        start = self._target_point[axis] - self._anchor_point[axis] * \
+            self._zoom
+        lowest = min(view_size - image_size - start, 0)
+        highest = max(-start, 0)
+        clamped = min(highest, max(lowest, delta))
+        if clamped != delta:
+            velocity = 0
+        return clamped, velocity
+
+    def _set_tile_store(self, tile_store):
+        # The caches of the store on screen are evicted last.
+        if self._tile_store is not None:
+            self._tile_store.set_visible(False)
+        self._tile_store = tile_store
+        self._tile_store.set_visible(True)
+        self._invalidate_rendering()
+
+    def _release_image(self):
+        # Release the memory of the image being replaced, unless it
+        # is kept as a page next to the new one.
+        if self._animation is not None:
+            self._animation.clear()
+            self._animation = None
+        if self._tile_store is not None and \
+                self._tile_store not in self._page_cache.values():
+            self._tile_store.clear()
+
+    def get_memory_stats(self):
+        # Usage and eviction counters of the memory budget, shared by
+        # all the viewers, for debugging.
+        return memory_budget.get_stats()
+
+    def trim_memory(self):
+        # Release what can be made again while the view isn't seen:
+        # tiles, scaled levels, animation frames, and the full
+        # resolution image, which is replaced by the pyramid level
+        # fitting the view.  Zooming in after restore_memory()
+        # decodes the full resolution again.  Returns the bytes
+        # released.
+        if self._trimmed or self._tile_store is None or \
+                self._decoder is not None or self._loading:
+            return 0
+
+        self._trimmed = True
+        usage = memory_budget.usage
+
+        if self._full_decoder is not None:
+            self._full_decoder.cancel()
+            self._full_decoder = None
+
+        if self._pages is not None:
+            for page in list(self._page_cache.keys()):
+                if self._page_cache[page] is not self._tile_store:
+                    self._page_cache.pop(page).clear()
+            for decoder in self._page_decoders.values():
+                decoder.cancel()
+            self._page_decoders = {}
+
+        tile_store = None
+        if self._animation is not None:
+            # The frame on screen stays in the cache, with its tiles
+            # dropped below.
+            self._animation.trim(self._animation_frame)
+        elif self._file_location is not None:
+            tile_store = self._tile_store.reduce(self._get_fit_scale())
+
+        if tile_store is not None:
+            self._tile_store.clear()
+            self._set_tile_store(tile_store)
+        else:
+            self._tile_store.drop_caches()
+            self._invalidate_rendering()
+
+        # Only the frame on screen is kept.
+        if self._spare_frame is not None:
+            self._spare_frame = None
+            width, height = self._frame_size
+            memory_budget.pin(self, width * height * 4)
+
+        released = usage - memory_budget.usage
+        logging.debug('Trimmed %dKB of image memory', released // 1024)
+        return released
+
+    def restore_memory(self):
+        # Resume after trim_memory().  What was released is made
+        # again when painted.
+        if not self._trimmed:
+            return
+
+        self._trimmed = False
+        self._restore_time = GLib.get_monotonic_time()
+        if self._animation is not None:
+            self._animation_deadline = None
+            self._set_tile_store(
+                self._animation.get_frame(self._animation_frame))
+            self._ensure_tick()
+        if self._pages is not None and not self._loading:
+            self._prefetch_pages()
+        self.queue_draw()
+
+    def _invalidate_rendering(self):
+        # Drop everything rendered from the tiles.
+        self._scaled_tiles.clear()
+        self._device_tiles.clear()
+        self._frame_state = None
+        self._last_level = None
+
     def do_get_property(self, prop):
         # We don't use the getter but GTK wants it defined as we are
         # implementing Gtk.Scrollable interface.
@@ -129,22 +2264,12 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
 
     def _update_adjustments(self):
         alloc = self.get_allocation()
-        scaled_width = self._surface.get_width() * self._zoom
-        scaled_height = self._surface.get_height() * self._zoom
+        image_width, image_height = self._get_image_size()
+        scaled_width = image_width * self._zoom
+        scaled_height = image_height * self._zoom
 
         page_size_x = alloc.width * 1.0 / scaled_width
-        self._hadj.set_lower(0)
-        self._hadj.set_page_size(page_size_x)
-        self._hadj.set_upper(1.0)
-        self._hadj.set_step_increment(0.1)
-        self._hadj.set_page_increment(0.5)
-
         page_size_y = alloc.height * 1.0 / scaled_height
-        self._vadj.set_lower(0)
-        self._vadj.set_page_size(page_size_y)
-        self._vadj.set_upper(1.0)
-        self._vadj.set_step_increment(0.1)
-        self._vadj.set_page_increment(0.5)
 
         anchor_scaled = (self._anchor_point[0] * self._zoom,
                          self._anchor_point[1] * self._zoom)
@@ -161,25 +2286,29 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
 
         # This two linear functions map the topleft corner of the
         # image to the value each adjustment.
-
+        value_x = self._hadj.get_value()
         if max_topleft[0] != 0:
-            self._hadj.disconnect(self._hadj_value_changed_hid)
-            self._hadj.set_value(-1 * max_value[0] *
-                                 scaled_image_topleft[0] / max_topleft[0])
-            self._hadj_value_changed_hid = \
-                self._hadj.connect('value-changed',
-                                   self.__hadj_value_changed_cb)
-
+            value_x = -1 * max_value[0] * scaled_image_topleft[0] / \
+                max_topleft[0]
+        value_y = self._vadj.get_value()
         if max_topleft[1] != 0:
-            self._vadj.disconnect(self._vadj_value_changed_hid)
-            self._vadj.set_value(-1 * max_value[1] *
-                                 scaled_image_topleft[1] / max_topleft[1])
-            self._vadj_value_changed_hid = \
-                self._vadj.connect('value-changed',
-                                   self.__vadj_value_changed_cb)
+            value_y = -1 * max_value[1] * scaled_image_topleft[1] / \
+                max_topleft[1]
+
+        # The values changed here already match the view, the guard
+        # keeps the value-changed handlers from scrolling it again.
+        # Each adjustment is changed at once, so it only notifies its
+        # scrollbar once.
+        self._updating_adjustments = True
+        try:
+            self._hadj.configure(value_x, 0, 1.0, 0.1, 0.5, page_size_x)
+            self._vadj.configure(value_y, 0, 1.0, 0.1, 0.5, page_size_y)
+        finally:
+            self._updating_adjustments = False
 
     def _stop_scrolling(self):
         self._in_scrolling = False
+        self._scrolling_hid = None
         self.queue_draw()
         return False
 
@@ -192,12 +2321,26 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
         # scrolling.
         if self._scrolling_hid is not None:
             GObject.source_remove(self._scrolling_hid)
-        self._scrolling_hid = GObject.timeout_add(200,
-                                                  self._stop_scrolling)
+        self._scrolling_hid = GObject.timeout_add(
+            self._quality.get_idle_delay(), self._stop_scrolling)
 
     def __hadj_value_changed_cb(self, adj):
+        if not self._updating_adjustments:
+            self._pending_scroll[0] = True
+            self._start_scrolling()
+            self._queue_input()
+
+    def __vadj_value_changed_cb(self, adj):
+        if not self._updating_adjustments:
+            self._pending_scroll[1] = True
+            self._start_scrolling()
+            self._queue_input()
+
+    def _scroll_horizontally(self):
+        # Move the image to the value of the horizontal adjustment.
+        adj = self._hadj
         alloc = self.get_allocation()
-        scaled_width = self._surface.get_width() * self._zoom
+        scaled_width = self._get_image_size()[0] * self._zoom
         anchor_scaled_x = self._anchor_point[0] * self._zoom
         scaled_image_left = self._target_point[0] - anchor_scaled_x
 
@@ -205,16 +2348,17 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
         max_value = 1.0 - adj.get_page_size()
         new_left = -1 * max_left * adj.get_value() / max_value
 
-        delta_x = scaled_image_left - new_left
-        self._anchor_point = (self._anchor_point[0] + delta_x,
+        # Scroll by whole pixels, so the previous frame can be
+        # reused by shifting it.
+        delta_x = round(scaled_image_left - new_left)
+        self._anchor_point = (self._anchor_point[0] + delta_x / self._zoom,
                               self._anchor_point[1])
 
-        self._start_scrolling()
-        self.queue_draw()
-
-    def __vadj_value_changed_cb(self, adj):
+    def _scroll_vertically(self):
+        # Move the image to the value of the vertical adjustment.
+        adj = self._vadj
         alloc = self.get_allocation()
-        scaled_height = self._surface.get_height() * self._zoom
+        scaled_height = self._get_image_size()[1] * self._zoom
         anchor_scaled_y = self._anchor_point[1] * self._zoom
         scaled_image_top = self._target_point[1] - anchor_scaled_y
 
@@ -222,20 +2366,45 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
         max_value = 1.0 - adj.get_page_size()
         new_top = -1 * max_top * adj.get_value() / max_value
 
-        delta_y = scaled_image_top - new_top
+        delta_y = round(scaled_image_top - new_top)
         self._anchor_point = (self._anchor_point[0],
-                              self._anchor_point[1] + delta_y)
+                              self._anchor_point[1] + delta_y / self._zoom)
+
+    def _get_image_size(self):
+        # Size of the image as displayed, that is once rotated.
+        if self._orientation % 2 == 1:
+            return (self._tile_store.height, self._tile_store.width)
+        return (self._tile_store.width, self._tile_store.height)
+
+    def _get_view_matrix(self):
+        # Transformation from image coordinates to widget
+        # coordinates.  The anchor point is in the coordinates of the
+        # rotated image.
+        matrix = cairo.Matrix()
+        matrix.translate(*self._target_point)
+        zoom_absolute = self._zoom * self._zoomtouch_scale
+        matrix.scale(zoom_absolute, zoom_absolute)
+        matrix.translate(self._anchor_point[0] * -1,
+                         self._anchor_point[1] * -1)
 
-        self._start_scrolling()
-        self.queue_draw()
+        orientation_matrix = _orientation_matrix(
+            self._orientation, self._tile_store.width,
+            self._tile_store.height, self._mirrored)
+        return orientation_matrix.multiply(matrix)
+
+    def get_pixbuf(self):
+        # Rotated pixels are only materialized here, for callers
+        # that need them, at the best resolution decoded so far.
+        return _orient_pixbuf(self._tile_store.get_pixbuf(),
+                              self._orientation, self._mirrored)
 
     def _center_target_point(self):
         alloc = self.get_allocation()
         self._target_point = (alloc.width / 2, alloc.height / 2)
 
     def _center_anchor_point(self):
-        self._anchor_point = (self._surface.get_width() / 2,
-                              self._surface.get_height() / 2)
+        image_width, image_height = self._get_image_size()
+        self._anchor_point = (image_width / 2, image_height / 2)
 
     def _center_if_small(self):
         # If at the current size the image surface is smaller than the
@@ -243,8 +2412,9 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
 
         alloc = self.get_allocation()
 
-        scaled_width = self._surface.get_width() * self._zoom
-        scaled_height = self._surface.get_height() * self._zoom
+        image_width, image_height = self._get_image_size()
+        scaled_width = image_width * self._zoom
+        scaled_height = image_height * self._zoom
 
         if alloc.width >= scaled_width and alloc.height >= scaled_height:
             self._center_target_point()
@@ -254,50 +2424,64 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
     def set_zoom(self, zoom):
         if zoom < ZOOM_MIN or zoom > ZOOM_MAX:
             return
+        if self._loading:
+            self._pending_zoom = zoom
+            return
+        self._stop_zoom_animation()
         self._zoom = zoom
         self.queue_draw()
 
     def get_zoom(self):
+        # The zoom being animated to, if any.
+        if self._zoom_target is not None:
+            return self._zoom_target
         return self._zoom
 
     def can_zoom_in(self):
-        return self._zoom + ZOOM_STEP < ZOOM_MAX
+        if self._zoom is None:
+            return False
+        return self.get_zoom() + ZOOM_STEP < ZOOM_MAX
         self._update_adjustments()
 
     def can_zoom_out(self):
-        return self._zoom - ZOOM_STEP > ZOOM_MIN
+        if self._zoom is None:
+            return False
+        return self.get_zoom() - ZOOM_STEP > ZOOM_MIN
         self._update_adjustments()
 
     def zoom_in(self):
+        # Steps add up to the zoom being animated to.
         if not self.can_zoom_in():
             return
-        self._zoom += ZOOM_STEP
-        self._update_adjustments()
-        self.queue_draw()
+        self._animate_zoom(self.get_zoom() + ZOOM_STEP)
 
     def zoom_out(self):
         if not self.can_zoom_out():
             return
-        self._zoom -= ZOOM_MIN
+        self._animate_zoom(self.get_zoom() - ZOOM_MIN)
 
-        self._center_if_small()
-        self._update_adjustments()
-        self.queue_draw()
+    def _get_fit_scale(self):
+        # The zoom showing the whole image in the view, or 1 if it
+        # fits already.
+        alloc = self.get_allocation()
+        image_width, image_height = self._get_image_size()
+        return min(1.0, alloc.width * 1.0 / image_width,
+                   alloc.height * 1.0 / image_height)
 
     def zoom_to_fit(self):
         # This tries to figure out a best fit model
         # If the image can fit in, we show it in 1:1,
         # in any other case we show it in a fit to screen way
 
+        self._stop_zoom_animation()
         alloc = self.get_allocation()
 
-        surface_width = self._surface.get_width()
-        surface_height = self._surface.get_height()
+        image_width, image_height = self._get_image_size()
 
-        if alloc.width < surface_width or alloc.height < surface_height:
+        if alloc.width < image_width or alloc.height < image_height:
             # Image is larger than allocated size
-            self._zoom = min(alloc.width * 1.0 / surface_width,
-                             alloc.height * 1.0 / surface_height)
+            self._zoom = min(alloc.width * 1.0 / image_width,
+                             alloc.height * 1.0 / image_height)
         else:
             self._zoom = 1.0
 
@@ -307,6 +2491,7 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
         self.queue_draw()
 
     def zoom_original(self):
+        self._stop_zoom_animation()
         self._zoom = 1
         self._center_if_small()
         self._update_adjustments()
@@ -329,9 +2514,20 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
         self._anchor_point = (int(anchor_scaled[0] * 1.0 / self._zoom),
                               int(anchor_scaled[1] * 1.0 / self._zoom))
 
+    def _add_drag_sample(self, coords):
+        now = GLib.get_monotonic_time() / 1000.0
+        self._drag_samples.append((now, coords[1], coords[2]))
+        while now - self._drag_samples[0][0] > KINETIC_WINDOW:
+            self._drag_samples.popleft()
+
     def start_dragtouch(self, coords):
         self._in_dragtouch = True
 
+        # Touching the view stops it moving.
+        self._stop_kinetic()
+        self._drag_samples.clear()
+        self._add_drag_sample(coords)
+
         prev_target_point = self._target_point
 
         # Set target point to the relative coordinates of this view.
@@ -350,21 +2546,28 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
             self.start_dragtouch(coords)
             return
 
-        self._target_point = (coords[1], coords[2])
-        self._update_adjustments()
-        self.queue_draw()
+        self._add_drag_sample(coords)
+        self._pending_target = (coords[1], coords[2])
+        self._queue_input()
 
     def finish_dragtouch(self, coords):
+        self._apply_input()
         self._in_dragtouch = False
-        self._center_if_small()
+        self._add_drag_sample(coords)
+        self._start_kinetic()
+        if self._kinetic_velocity is None:
+            self._center_if_small()
         self._update_adjustments()
 
     def start_zoomtouch(self, center):
         self._in_zoomtouch = True
         self._zoomtouch_scale = 1
 
-        # Zoom touch replaces drag touch.
+        # Zoom touch replaces drag touch, and zoom animations.
         self._in_dragtouch = False
+        self._stop_kinetic()
+        self._stop_zoom_animation()
+        self._drag_samples.clear()
 
         prev_target_point = self._target_point
 
@@ -376,15 +2579,11 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
         self.queue_draw()
 
     def update_zoomtouch(self, center, scale):
-        self._zoomtouch_scale = scale
-
-        # Set target point to the relative coordinates of this view.
-        alloc = self.get_allocation()
-        self._target_point = (center[1] - alloc.x, center[2] - alloc.y)
-
-        self.queue_draw()
+        self._pending_zoomtouch = (center, scale)
+        self._queue_input()
 
     def finish_zoomtouch(self):
+        self._apply_input()
         self._in_zoomtouch = False
 
         # Apply zoom
@@ -402,38 +2601,35 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
         self.queue_draw()
 
     def rotate_anticlockwise(self):
-        self._surface = _rotate_surface(self._surface, -1)
+        self._orientation = (self._orientation - 1) % 4
 
         # Recalculate the anchor point to make it relative to the new
         # top left corner.
         self._anchor_point = (
             self._anchor_point[1],
-            self._surface.get_height() - self._anchor_point[0])
+            self._get_image_size()[1] - self._anchor_point[0])
 
         self._update_adjustments()
         self.queue_draw()
 
     def rotate_clockwise(self):
-        self._surface = _rotate_surface(self._surface, 1)
+        self._orientation = (self._orientation + 1) % 4
 
         # Recalculate the anchor point to make it relative to the new
         # top left corner.
         self._anchor_point = (
-            self._surface.get_width() - self._anchor_point[1],
+            self._get_image_size()[0] - self._anchor_point[1],
             self._anchor_point[0])
 
         self._update_adjustments()
         self.queue_draw()
 
+    @perftrace.traced('paint')
     def __draw_cb(self, widget, ctx):
 
-        # If the image surface is not set, it reads it from the file
-        # location.  If the file location is not set yet, it just
-        # returns.
-        if self._surface is None:
-            if self._file_location is None:
-                return
-            self._surface = _surface_from_file(self._file_location, ctx)
+        # Nothing is painted until the first image is decoded.
+        if self._tile_store is None:
+            return
 
         if self._zoom is None:
             self.zoom_to_fit()
@@ -449,17 +2645,329 @@ class ImageViewer(Gtk.DrawingArea, Gtk.Scrollable):
             self._center_anchor_point()
             self._update_adjustments()
 
-        ctx.translate(*self._target_point)
+        start_time = GLib.get_monotonic_time()
         zoom_absolute = self._zoom * self._zoomtouch_scale
-        ctx.scale(zoom_absolute, zoom_absolute)
+        zooming = self._in_zoomtouch or self._zoom_target is not None
+        interacting = zooming or self._in_dragtouch or \
+            self._in_scrolling or self._kinetic_velocity is not None
+
+        # Interactive frames are painted at the quality that keeps
+        # them within the frame budget.
+        tile_filter = cairo.FILTER_BEST
+        level_scale = zoom_absolute
+        if interacting:
+            tile_filter, level_bias = self._quality.get_quality()
+            level_scale = zoom_absolute / 2 ** level_bias
+
+        # Zooming past the reduced size the image was first decoded
+        # to needs the full resolution.  Meanwhile the reduced image
+        # is upscaled.
+        if not self._tile_store.covers_scale(zoom_absolute):
+            self._decode_full_resolution()
+
+        # Paint from the pyramid level matching the zoom.  While
+        # zooming, tiles are not converted or rendered again for every
+        # step: the previous level, whose tiles are cached, is kept
+        # while it stays close enough.
+        level = self._tile_store.get_level_for_scale(level_scale)
+        if zooming and self._last_level is not None and \
+                abs(self._last_level - level) <= 1:
+            level = self._last_level
+        self._last_level = level
+
+        # Until a level is scaled, in the background, another one
+        # already scaled is painted, a coarser one if any.
+        level = self._tile_store.get_ready_level(level,
+                                                 self.__level_ready_cb)
+        scale_x, scale_y = self._tile_store.get_level_scale(level)
+
+        # When idle, paint tiles already scaled to the zoom, unless
+        # that would make them too large.
+        tile_scale = (zoom_absolute / scale_x, zoom_absolute / scale_y)
+        if interacting or max(tile_scale) > SCALED_MAX or \
+                tile_scale == (1, 1):
+            tile_scale = None
 
-        ctx.translate(self._anchor_point[0] * -1, self._anchor_point[1] * -1)
+        alloc = self.get_allocation()
+        view_matrix = self._get_view_matrix()
+        state = (zoom_absolute, self._orientation, self._mirrored, level,
+                 tile_filter, tile_scale, alloc.width, alloc.height)
+        offset = self._get_frame_offset(view_matrix, state)
+        rendered_pixels = 0
+
+        # A frame rendered again only over the area GTK asks for,
+        # which is often a small part of the view, such as a tooltip
+        # or a scrollbar being redrawn, costs time in proportion to
+        # that area.  The rest of the frame is then stale, and the
+        # next frame is rendered again.
+        clip_x1, clip_y1, clip_x2, clip_y2 = ctx.clip_extents()
+        clip_x1 = max(0, int(math.floor(clip_x1)))
+        clip_y1 = max(0, int(math.floor(clip_y1)))
+        clip_x2 = min(alloc.width, int(math.ceil(clip_x2)))
+        clip_y2 = min(alloc.height, int(math.ceil(clip_y2)))
+        rectangle = (clip_x1, clip_y1, clip_x2 - clip_x1, clip_y2 - clip_y1)
+        partial = rectangle != (0, 0, alloc.width, alloc.height)
+
+        self._prepare_tiles(view_matrix, level, alloc.width, alloc.height,
+                            rectangle if offset is None else None,
+                            tile_scale if offset is None and not partial
+                            else None, zoom_absolute)
+
+        if offset is None:
+            # Render the frame again, over the clip area.
+            if not partial:
+                self._fallback_tiles.clear()
+            if self._frame_size != (alloc.width, alloc.height):
+                self._frame = ctx.get_target().create_similar(
+                    cairo.CONTENT_COLOR_ALPHA, alloc.width, alloc.height)
+                self._frame_size = (alloc.width, alloc.height)
+                self._spare_frame = None
+                memory_budget.pin(self, alloc.width * alloc.height * 4)
+            self._render(cairo.Context(self._frame), view_matrix, level,
+                         rectangle, tile_filter, tile_scale, zoom_absolute)
+            rendered_pixels = rectangle[2] * rectangle[3]
+            if partial:
+                state = None
+
+        elif offset != (0, 0):
+            # Shift the previous frame into the spare one, and only
+            # render the strips it doesn't cover.
+            if self._spare_frame is None:
+                self._spare_frame = ctx.get_target().create_similar(
+                    cairo.CONTENT_COLOR_ALPHA, alloc.width, alloc.height)
+                memory_budget.pin(self, alloc.width * alloc.height * 8)
+            frame_ctx = cairo.Context(self._spare_frame)
+            frame_ctx.set_operator(cairo.OPERATOR_SOURCE)
+            frame_ctx.set_source_surface(self._frame, *offset)
+            frame_ctx.paint()
+            frame_ctx.set_operator(cairo.OPERATOR_OVER)
+            self._frame, self._spare_frame = self._spare_frame, self._frame
+
+            dx, dy = offset
+            strips = []
+            if dx > 0:
+                strips.append((0, 0, dx, alloc.height))
+            elif dx < 0:
+                strips.append((alloc.width + dx, 0, -dx, alloc.height))
+            if dy > 0:
+                strips.append((0, 0, alloc.width, dy))
+            elif dy < 0:
+                strips.append((0, alloc.height + dy, alloc.width, -dy))
+            for strip in strips:
+                self._render(frame_ctx, view_matrix, level, strip,
+                             tile_filter, tile_scale, zoom_absolute)
+                rendered_pixels += strip[2] * strip[3]
+
+        self._frame_matrix = view_matrix
+        self._frame_state = state
+
+        ctx.set_source_surface(self._frame, 0, 0)
+        ctx.paint()
+
+        duration = (GLib.get_monotonic_time() - start_time) / 1000.0
+        self._quality.record(tile_filter, rendered_pixels, duration,
+                             interacting)
 
-        ctx.set_source_surface(self._surface, 0, 0)
+        if self._restore_time is not None:
+            logging.debug('Restored the view in %.1fms',
+                          (GLib.get_monotonic_time() -
+                           self._restore_time) / 1000.0)
+            self._restore_time = None
 
-        # Perform faster draw if the view is zooming or scrolling via
-        # mouse or touch.
-        if self._in_zoomtouch or self._in_dragtouch or self._in_scrolling:
-            ctx.get_source().set_filter(cairo.FILTER_NEAREST)
+    def __level_ready_cb(self):
+        self.queue_draw()
 
+    def _prepare_tiles(self, view_matrix, level, width, height,
+                       rectangle, tile_scale, zoom):
+        # Have the tile pool render the tiles in view, closest to the
+        # centre first, and cancel those no longer in view.  Tiles
+        # still pending are painted from a coarser level meanwhile,
+        # only those without one in the rectangle to render, in
+        # widget coordinates, are waited for.  Tiles scaled to the
+        # zoom are resampled in the pool too.
+        scale_x, scale_y = self._tile_store.get_level_scale(level)
+        matrix = cairo.Matrix(1.0 / scale_x, 0, 0, 1.0 / scale_y, 0, 0)
+        matrix = matrix.multiply(view_matrix)
+        matrix.invert()
+        center_x, center_y = matrix.transform_point(width / 2.0,
+                                                    height / 2.0)
+        visible = _transform_rectangle(matrix, 0, 0, width, height)
+        cols, rows = self._tile_store.get_tile_range(level, *visible)
+
+        tiles = []
+        for row in rows:
+            for col in cols:
+                distance = math.hypot((col + 0.5) * TILE_SIZE - center_x,
+                                      (row + 0.5) * TILE_SIZE - center_y)
+                tiles.append((col, row, distance))
+
+        # Tiles already uploaded don't need rendering again.
+        missing = [(col, row, distance) for col, row, distance in tiles
+                   if (level, col, row) not in self._device_tiles]
+        self._tile_store.request_tiles(level, missing, self.__tile_ready_cb)
+
+        if rectangle is None:
+            rectangle = (0, 0, width, height)
+        cols, rows = self._tile_store.get_tile_range(
+            level, *_transform_rectangle(matrix, *rectangle))
+        self._tile_store.wait_tiles([
+            (level, col, row) for col, row, distance in missing
+            if col in cols and row in rows and
+            self._tile_store.find_tile(level, col, row)[0] is None])
+
+        if tile_scale is None:
+            return
+        jobs = []
+        for col, row, distance in tiles:
+            key = (level, col, row, zoom)
+            tile, tile_level = self._tile_store.find_tile(level, col, row)
+            if tile_level == level and key not in self._scaled_tiles:
+                jobs.append(tile_pool.submit(
+                    _scale_surface, (tile,) + tile_scale, distance,
+                    self.__tile_scaled_cb, key))
+        tile_pool.wait(jobs)
+
+    def __tile_ready_cb(self, key):
+        # A tile painted from a coarser level is ready, the frame is
+        # rendered again.
+        if key in self._fallback_tiles:
+            self._frame_state = None
+            self.queue_draw()
+
+    def __tile_scaled_cb(self, job, key):
+        if job.result is not None:
+            self._scaled_tiles.add(key, self._upload_tile(job.result),
+                                   _get_size(job.result))
+
+    def _upload_tile(self, tile):
+        window = self.get_window()
+        if not self._device_surfaces or window is None:
+            return tile
+        return _upload_surface(window, tile)
+
+    def _get_device_tile(self, tile, key):
+        # A tile left in client memory is already charged to the
+        # cache of its store.
+        device_tile = self._device_tiles.get(key)
+        if device_tile is None:
+            device_tile = self._upload_tile(tile)
+            if device_tile is not tile:
+                self._device_tiles.add(key, device_tile, _get_size(tile))
+        return device_tile
+
+    def _get_frame_offset(self, view_matrix, state):
+        # Return the offset in whole pixels between the previous
+        # frame and the one to render, or None if the previous frame
+        # can't be reused.
+        if self._frame_state != state:
+            return None
+
+        x0, y0 = view_matrix.transform_point(0, 0)
+        previous_x0, previous_y0 = self._frame_matrix.transform_point(0, 0)
+        dx = x0 - previous_x0
+        dy = y0 - previous_y0
+        if abs(dx - round(dx)) > 0.001 or abs(dy - round(dy)) > 0.001:
+            return None
+        return (int(round(dx)), int(round(dy)))
+
+    @perftrace.traced('render')
+    def _render(self, ctx, view_matrix, level, rectangle, tile_filter,
+                tile_scale, zoom):
+        # Render the image over the rectangle, in widget coordinates.
+        ctx.save()
+        ctx.rectangle(*rectangle)
+        ctx.clip()
+
+        ctx.set_operator(cairo.OPERATOR_CLEAR)
         ctx.paint()
+        ctx.set_operator(cairo.OPERATOR_OVER)
+
+        scale_x, scale_y = self._tile_store.get_level_scale(level)
+        matrix = cairo.Matrix(1.0 / scale_x, 0, 0, 1.0 / scale_y, 0, 0)
+        matrix = matrix.multiply(view_matrix)
+        ctx.transform(matrix)
+
+        # While the image is being decoded, only the area decoded so
+        # far is painted.
+        valid = self._tile_store.get_valid_rectangle(level)
+        if valid is not None:
+            ctx.rectangle(*valid)
+            ctx.clip()
+
+        # Only the tiles intersecting the rectangle are painted, and
+        # only over their visible part.
+        matrix.invert()
+        visible = _transform_rectangle(matrix, *rectangle)
+        cols, rows = self._tile_store.get_tile_range(level, *visible)
+
+        # Tiles are filled without antialiasing and with padded
+        # sources, so neighbouring tiles meet without seams.
+        ctx.set_antialias(cairo.ANTIALIAS_NONE)
+        for row in rows:
+            for col in cols:
+                self._paint_tile(ctx, level, col, row, visible,
+                                 tile_filter, tile_scale, zoom)
+        ctx.restore()
+
+    def _paint_tile(self, ctx, level, col, row, visible, tile_filter,
+                    tile_scale, zoom):
+        # The tile, or the coarser one painted in its place while the
+        # tile pool renders it, uploaded to a device surface.
+        tile = self._device_tiles.get((level, col, row))
+        tile_level = level
+        if tile is None:
+            tile, tile_level = self._tile_store.find_tile(level, col, row)
+            if tile is None:
+                tile = self._tile_store.get_tile(level, col, row)
+                tile_level = level
+            shift = tile_level - level
+            tile = self._get_device_tile(
+                tile, (tile_level, col >> shift, row >> shift))
+        level_width, level_height = self._tile_store.get_level_size(level)
+        x = col * TILE_SIZE
+        y = row * TILE_SIZE
+
+        # The part of the tile inside the visible area, in level
+        # coordinates.
+        x1 = max(x, math.floor(visible[0]))
+        y1 = max(y, math.floor(visible[1]))
+        x2 = min(x + TILE_SIZE, level_width,
+                 math.ceil(visible[0] + visible[2]))
+        y2 = min(y + TILE_SIZE, level_height,
+                 math.ceil(visible[1] + visible[3]))
+        if x1 >= x2 or y1 >= y2:
+            return
+
+        ctx.save()
+        key = (level, col, row, zoom)
+        scaled_tile = None
+        if tile_scale is not None:
+            scaled_tile = self._scaled_tiles.get(key)
+
+        if tile_level != level:
+            # The tile is still rendered by the pool, the coarser
+            # tile covering it is upscaled in its place.
+            self._fallback_tiles.add((level, col, row))
+            shift = tile_level - level
+            level_scale_x, level_scale_y = \
+                self._tile_store.get_level_scale(level)
+            tile_scale_x, tile_scale_y = \
+                self._tile_store.get_level_scale(tile_level)
+            ctx.rectangle(x1, y1, x2 - x1, y2 - y1)
+            ctx.scale(level_scale_x / tile_scale_x,
+                      level_scale_y / tile_scale_y)
+            _fill_surface(ctx, tile, (col >> shift) * TILE_SIZE,
+                          (row >> shift) * TILE_SIZE, tile_filter)
+        elif scaled_tile is not None:
+            # The scaled tile is painted 1:1, in its own coordinates.
+            ctx.scale(1.0 / tile_scale[0], 1.0 / tile_scale[1])
+            ctx.rectangle(x1 * tile_scale[0], y1 * tile_scale[1],
+                          (x2 - x1) * tile_scale[0],
+                          (y2 - y1) * tile_scale[1])
+            _fill_surface(ctx, scaled_tile, x * tile_scale[0],
+                          y * tile_scale[1], cairo.FILTER_NEAREST)
+        else:
+            ctx.rectangle(x1, y1, x2 - x1, y2 - y1)
+            _fill_surface(ctx, tile, x, y, tile_filter)
+
+        ctx.restore()
@@ -55,6 +55,7 @@ except:
 
 import collabwrapper
 import ImageView
+import perftrace
 
 
 class ProgressAlert(Alert):
@@ -100,6 +101,8 @@ class ImageViewerActivity(activity.Activity):
         self._zoom_in_button = None
         self.previous_image_button = None
         self.next_image_button = None
+        self.image_count = 0
+        self.current_image_index = 0
 
         self.scrolled_window = Gtk.ScrolledWindow()
         self.scrolled_window.set_policy(Gtk.PolicyType.ALWAYS,
@@ -108,10 +111,11 @@ class ImageViewerActivity(activity.Activity):
         self.max_participants = 1
 
         # Don't use the default kinetic scrolling, let the view do the
-        # drag-by-touch and pinch-to-zoom logic.
+        # drag-by-touch, kinetic panning and pinch-to-zoom logic.
         self.scrolled_window.set_kinetic_scrolling(False)
 
         self.view = ImageView.ImageViewer()
+        self.view.connect('image-loaded', self.__image_loaded_cb)
 
         # Connect to the touch signal for performing drag-by-touch.
         self.view.add_events(Gdk.EventMask.TOUCH_MASK)
@@ -182,8 +186,41 @@ class ImageViewerActivity(activity.Activity):
             self.scrolled_window.show()
 
         Gdk.Screen.get_default().connect('size-changed', self._configure_cb)
+
+        # Sugar keeps the activities in the background running, the
+        # view gives back what memory it can while this one isn't
+        # seen.
+        self._obscured = False
+        self.add_events(Gdk.EventMask.VISIBILITY_NOTIFY_MASK)
+        self.connect('visibility-notify-event', self.__visibility_notify_cb)
+        self.connect('notify::active', self.__notify_active_cb)
+
         self._collab.setup()
 
+    def __image_loaded_cb(self, view):
+        self._update_zoom_buttons()
+
+        # The previous and next buttons go through the pages of a
+        # multi-page document first.
+        if self.view.get_page_count() > 1:
+            self.previous_image_button.show()
+            self.next_image_button.show()
+        self.make_button_sensitive()
+
+    def __visibility_notify_cb(self, widget, event):
+        self._obscured = \
+            event.state == Gdk.VisibilityState.FULLY_OBSCURED
+        self._update_memory_use()
+
+    def __notify_active_cb(self, widget, pspec):
+        self._update_memory_use()
+
+    def _update_memory_use(self):
+        if self.props.active and not self._obscured:
+            self.view.restore_memory()
+        else:
+            self.view.trim_memory()
+
     def __touch_event_cb(self, widget, event):
         coords = event.get_coords()
         if event.type == Gdk.EventType.TOUCH_BEGIN:
@@ -210,9 +247,9 @@ class ImageViewerActivity(activity.Activity):
     def __key_press_cb(self, widget, event):
         key_name = Gdk.keyval_name(event.keyval)
         if key_name == "Left":
-            self._change_image(-1)
+            self._navigate(-1)
         elif key_name == "Right":
-            self._change_image(1)
+            self._navigate(1)
         elif event.get_state() & Gdk.ModifierType.CONTROL_MASK:
             if key_name == "q":
                 self.close()
@@ -283,21 +320,24 @@ class ImageViewerActivity(activity.Activity):
             toolbar_box.toolbar.insert(self._seps[-1], -1)
             self._seps[-1].show()
 
-            self.previous_image_button = ToolButton('go-previous-paired')
-            self.previous_image_button.set_tooltip(_('Previous Image'))
-            self.previous_image_button.props.sensitive = False
-            self.previous_image_button.connect('clicked',
-                                               self.__previous_image_cb)
-            toolbar_box.toolbar.insert(self.previous_image_button, -1)
-            self.previous_image_button.show()
+        # Without a list of images to go through, the buttons are
+        # only shown for multi-page documents.
+        self.previous_image_button = ToolButton('go-previous-paired')
+        self.previous_image_button.set_tooltip(_('Previous Image'))
+        self.previous_image_button.props.sensitive = False
+        self.previous_image_button.connect('clicked',
+                                           self.__previous_image_cb)
+        toolbar_box.toolbar.insert(self.previous_image_button, -1)
+
+        self.next_image_button = ToolButton('go-next-paired')
+        self.next_image_button.set_tooltip(_('Next Image'))
+        self.next_image_button.props.sensitive = False
+        self.next_image_button.connect('clicked', self.__next_image_cb)
+        toolbar_box.toolbar.insert(self.next_image_button, -1)
 
-            self.next_image_button = ToolButton('go-next-paired')
-            self.next_image_button.set_tooltip(_('Next Image'))
-            self.next_image_button.props.sensitive = False
-            self.next_image_button.connect('clicked', self.__next_image_cb)
-            toolbar_box.toolbar.insert(self.next_image_button, -1)
+        if self._object_id is None:
+            self.previous_image_button.show()
             self.next_image_button.show()
-
             GObject.idle_add(self._get_image_list)
 
         separator = Gtk.SeparatorToolItem()
@@ -322,11 +362,20 @@ class ImageViewerActivity(activity.Activity):
         self._zoom_in_button.set_sensitive(self.view.can_zoom_in())
         self._zoom_out_button.set_sensitive(self.view.can_zoom_out())
 
+    def _navigate(self, delta):
+        # Go to the previous or next page of a multi-page document,
+        # past its ends to the previous or next image.
+        page = self.view.get_page() + delta
+        if 0 <= page < self.view.get_page_count():
+            self.view.set_page(page)
+            self.make_button_sensitive()
+        else:
+            self._change_image(delta)
+
+    @perftrace.traced('change_image')
     def _change_image(self, delta):
         # boundary conditions
-        if self.current_image_index == 0 and delta == -1:
-            return
-        if self.current_image_index == self.image_count - 1 and delta == 1:
+        if not 0 <= self.current_image_index + delta < self.image_count:
             return
 
         self.current_image_index += delta
@@ -338,12 +387,10 @@ class ImageViewerActivity(activity.Activity):
         self.read_file(jobject.file_path)
 
     def __previous_image_cb(self, button):
-        if self.current_image_index > 0:
-            self._change_image(-1)
+        self._navigate(-1)
 
     def __next_image_cb(self, button):
-        if self.current_image_index < self.image_count:
-            self._change_image(1)
+        self._navigate(1)
 
     def __zoom_in_cb(self, button):
         self.view.zoom_in()
@@ -379,18 +426,16 @@ class ImageViewerActivity(activity.Activity):
         self.current_image_index = self.image_list.index(jobject)
 
     def make_button_sensitive(self):
-        if self.image_count <= 1:
+        page = self.view.get_page()
+        page_count = self.view.get_page_count()
+        if self.image_count <= 1 and page_count <= 1:
             return
 
-        if self.current_image_index == 0:
-            self.next_image_button.props.sensitive = True
-            self.previous_image_button.props.sensitive = False
-        elif self.current_image_index == self.image_count - 1:
-            self.previous_image_button.props.sensitive = True
-            self.next_image_button.props.sensitive = False
-        else:
-            self.next_image_button.props.sensitive = True
-            self.previous_image_button.props.sensitive = True
+        self.previous_image_button.props.sensitive = \
+            page > 0 or self.current_image_index > 0
+        self.next_image_button.props.sensitive = \
+            page < page_count - 1 or \
+            self.current_image_index < self.image_count - 1
 
     def _show_picker_cb(self, button):
         if not self._want_document:
@@ -419,6 +464,7 @@ class ImageViewerActivity(activity.Activity):
             chooser.destroy()
             del chooser
 
+    @perftrace.traced('read_file')
     def read_file(self, file_path):
         if self._object_id is None or self.shared_activity:
             # read_file is call because the canvas is visible
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Headless benchmark of the image viewer.
+
+Synthetic JPEG, PNG, SVG and GIF images of several sizes are written
+to a temporary directory, then an ImageViewer in an offscreen window
+goes through a script for each of them: open, fit, zoom in and out,
+pan, rotate and switch to the next image.  Every step is timed until
+its frame is painted into a surface similar to the window, and the
+display server is done with it.  Zoom steps are not animated, they
+time the frame at the zoom reached.  The latency percentiles and
+peak memory are reported.
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --baseline baseline.json
+
+With --image-surfaces, tiles are painted from client memory instead
+of being uploaded to device surfaces, to compare repaint costs.
+
+With --baseline, steps slower than the baseline by more than the
+tolerance, or a higher peak memory, are reported as regressions and
+the exit status is 1.
+'''
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import cairo
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+from gi.repository import Gdk
+
+import ImageView
+
+SIZES = {
+    'small': (800, 600),
+    'medium': (2048, 1536),
+    'large': (6000, 4000),
+}
+FORMATS = ('jpeg', 'png', 'svg', 'gif')
+
+# GIF files are encoded here, without compression, so they are kept
+# small whatever the size asked.
+GIF_MAX_SIZE = (640, 480)
+GIF_FRAMES = 4
+
+VIEW_SIZE = (1200, 900)
+ZOOM_STEPS = 5
+PAN_STEPS = 10
+LOAD_TIMEOUT = 60
+
+# Differences below this, in ms, are noise rather than regressions.
+NOISE_FLOOR = 1.0
+
+
+def _draw_pattern(ctx, width, height):
+    # Gradients and shapes, so the images compress like photos
+    # rather than flat colors.
+    gradient = cairo.LinearGradient(0, 0, width, height)
+    gradient.add_color_stop_rgb(0, 0.9, 0.3, 0.1)
+    gradient.add_color_stop_rgb(0.5, 0.2, 0.6, 0.9)
+    gradient.add_color_stop_rgb(1, 0.1, 0.8, 0.3)
+    ctx.set_source(gradient)
+    ctx.paint()
+
+    step = max(8, min(width, height) // 16)
+    for y in range(0, height, step):
+        for x in range(0, width, step):
+            shade = (x + y) // step % 5 / 5.0
+            ctx.set_source_rgba(shade, 1 - shade, 0.5, 0.6)
+            ctx.arc(x + step / 2, y + step / 2, step / 3, 0, 2 * math.pi)
+            ctx.fill()
+
+
+def _write_raster(path, file_format, width, height):
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    _draw_pattern(cairo.Context(surface), width, height)
+    pixbuf = Gdk.pixbuf_get_from_surface(surface, 0, 0, width, height)
+    if file_format == 'jpeg':
+        pixbuf.savev(path, 'jpeg', ['quality'], ['90'])
+    else:
+        pixbuf.savev(path, 'png', [], [])
+
+
+def _write_svg(path, width, height):
+    step = max(8, min(width, height) // 16)
+    shapes = []
+    for y in range(0, height, step):
+        for x in range(0, width, step):
+            shade = (x + y) * 255 // (width + height)
+            shapes.append('<circle cx="%d" cy="%d" r="%d" '
+                          'fill="rgb(%d,%d,128)" opacity="0.6"/>' %
+                          (x + step // 2, y + step // 2, step // 3,
+                           shade, 255 - shade))
+
+    with open(path, 'w') as svg_file:
+        svg_file.write(
+            '<svg xmlns="http://www.w3.org/2000/svg" width="%d" '
+            'height="%d">\n<defs><linearGradient id="g" x2="1" y2="1">'
+            '<stop offset="0" stop-color="#e64d1a"/>'
+            '<stop offset="1" stop-color="#1acc4d"/></linearGradient>'
+            '</defs>\n<rect width="100%%" height="100%%" fill="url(#g)"/>'
+            '\n%s\n</svg>\n' % (width, height, '\n'.join(shapes)))
+
+
+def _lzw_uncompressed(indices):
+    # Encode 8 bits indices as 9 bits literal codes, with a clear
+    # code often enough that the code size never grows.
+    codes = []
+    for start in range(0, len(indices), 250):
+        codes.append(256)
+        codes.extend(indices[start:start + 250])
+    codes.append(257)
+
+    data = bytearray()
+    bits = 0
+    bit_count = 0
+    for code in codes:
+        bits |= code << bit_count
+        bit_count += 9
+        while bit_count >= 8:
+            data.append(bits & 0xff)
+            bits >>= 8
+            bit_count -= 8
+    if bit_count:
+        data.append(bits & 0xff)
+    return data
+
+
+def _write_gif(path, width, height):
+    width = min(width, GIF_MAX_SIZE[0])
+    height = min(height, GIF_MAX_SIZE[1])
+
+    data = bytearray(b'GIF89a')
+    data += struct.pack('<HHBBB', width, height, 0xf7, 0, 0)
+    for index in range(256):
+        data += bytearray([index, (index * 7) % 256, 255 - index])
+    # Loop forever.
+    data += b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00'
+
+    step = max(8, min(width, height) // 16)
+    for frame in range(GIF_FRAMES):
+        indices = bytearray(
+            ((x // step + y // step) * 16 + frame * 40) % 256
+            for y in range(height) for x in range(width))
+        data += b'\x21\xf9\x04\x04' + struct.pack('<H', 10) + b'\x00\x00'
+        data += b'\x2c' + struct.pack('<HHHHB', 0, 0, width, height, 0)
+        data += b'\x08'
+        compressed = _lzw_uncompressed(indices)
+        for start in range(0, len(compressed), 255):
+            block = compressed[start:start + 255]
+            data += bytearray([len(block)]) + block
+        data += b'\x00'
+    data += b'\x3b'
+
+    with open(path, 'wb') as gif_file:
+        gif_file.write(data)
+
+
+def list_images(directory, sizes, formats):
+    # Return the (name, path, size name, format) of the synthetic
+    # images.
+    images = []
+    for size_name in sizes:
+        for file_format in formats:
+            name = '%s-%s' % (file_format, size_name)
+            path = os.path.join(directory, '%s.%s' % (name, file_format))
+            images.append((name, path, size_name, file_format))
+    return images
+
+
+def write_images(directory, sizes, formats):
+    for name, path, size_name, file_format in list_images(
+            directory, sizes, formats):
+        width, height = SIZES[size_name]
+        if file_format == 'svg':
+            _write_svg(path, width, height)
+        elif file_format == 'gif':
+            _write_gif(path, width, height)
+        else:
+            _write_raster(path, file_format, width, height)
+
+
+def write_images_apart(directory, sizes, formats):
+    # Drawing the large images takes more memory than viewing them,
+    # they are written by another process, so the peak RSS measured
+    # is the viewer's own.
+    subprocess.check_call(
+        [sys.executable, os.path.abspath(__file__),
+         '--write-images', directory, '--sizes'] + list(sizes) +
+        ['--formats'] + list(formats))
+
+
+def percentile(values, fraction):
+    # Nearest rank percentile of the values.
+    values = sorted(values)
+    rank = int(math.ceil(fraction * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class Benchmark(object):
+    """
+    Drive an ImageViewer in an offscreen window and time each step
+    until its frame is painted.
+    """
+
+    def __init__(self, device_surfaces=True):
+        self._window = Gtk.OffscreenWindow()
+        self._window.set_size_request(*VIEW_SIZE)
+
+        # Laid out as in the activity, the scrolled window shares its
+        # adjustments with the view.
+        self._scrolled_window = Gtk.ScrolledWindow()
+        self._scrolled_window.set_policy(Gtk.PolicyType.ALWAYS,
+                                         Gtk.PolicyType.ALWAYS)
+        self._view = ImageView.ImageViewer()
+        self._view.set_device_surfaces(device_surfaces)
+        self._view.set_zoom_animated(False)
+        self._view.connect('image-loaded', self.__image_loaded_cb)
+        self._scrolled_window.add(self._view)
+        self._window.add(self._scrolled_window)
+        self._window.show_all()
+        self._flush_events()
+
+        alloc = self._view.get_allocation()
+        self._surface = self._view.get_window().create_similar_surface(
+            cairo.CONTENT_COLOR_ALPHA, alloc.width, alloc.height)
+        self._loaded = False
+        self.timings = {}
+
+    def _flush_events(self):
+        while Gtk.events_pending():
+            Gtk.main_iteration_do(False)
+
+    def __image_loaded_cb(self, view):
+        self._loaded = True
+
+    def _paint(self):
+        self._flush_events()
+        self._view.draw(cairo.Context(self._surface))
+        self._surface.flush()
+        # Wait for the display server to have painted it.
+        self._view.get_display().sync()
+
+    def _time(self, name, step, action):
+        start = time.time()
+        action()
+        self._paint()
+        duration = (time.time() - start) * 1000
+        self.timings.setdefault('%s/%s' % (name, step), []).append(duration)
+
+    def _open(self, path):
+        self._loaded = False
+        self._view.set_file_location(path)
+        deadline = time.time() + LOAD_TIMEOUT
+        while not self._loaded:
+            if time.time() > deadline:
+                raise RuntimeError('Timed out loading %s' % path)
+            Gtk.main_iteration_do(True)
+
+    def _pan(self):
+        adjustments = (self._scrolled_window.get_hadjustment(),
+                       self._scrolled_window.get_vadjustment())
+        for adjustment in adjustments:
+            upper = adjustment.get_upper() - adjustment.get_page_size()
+            value = adjustment.get_value() + upper / PAN_STEPS
+            adjustment.set_value(min(value, upper))
+        # Scrolling is applied on the next frame clock tick, apply it
+        # now so the frame painted shows it.
+        self._view.flush_input()
+
+    def run_image(self, name, path, next_path):
+        self._time(name, 'open', lambda: self._open(path))
+        self._time(name, 'fit', self._view.zoom_to_fit)
+        for index in range(ZOOM_STEPS):
+            self._time(name, 'zoom_in', self._view.zoom_in)
+        for index in range(PAN_STEPS):
+            self._time(name, 'pan', self._pan)
+        for index in range(ZOOM_STEPS):
+            self._time(name, 'zoom_out', self._view.zoom_out)
+        for index in range(4):
+            self._time(name, 'rotate', self._view.rotate_clockwise)
+        self._time(name, 'switch', lambda: self._open(next_path))
+
+
+def run(images, runs, device_surfaces):
+    benchmark = Benchmark(device_surfaces)
+    for run_index in range(runs):
+        for index, (name, path, size_name, file_format) in \
+                enumerate(images):
+            next_path = images[(index + 1) % len(images)][1]
+            benchmark.run_image(name, path, next_path)
+
+    steps = {}
+    for key, values in sorted(benchmark.timings.items()):
+        steps[key] = {
+            'count': len(values),
+            'p50': percentile(values, 0.5),
+            'p90': percentile(values, 0.9),
+            'p99': percentile(values, 0.99),
+            'max': max(values),
+        }
+
+    # ru_maxrss is in kilobytes on Linux.  The process writing the
+    # images is a child, not counted.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {
+        'steps': steps,
+        'peak_rss': peak_rss,
+        'peak_budget': ImageView.memory_budget.get_stats()['peak'],
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Return the descriptions of the regressions against the
+    # baseline.
+    regressions = []
+    for key, base in sorted(baseline['steps'].items()):
+        step = results['steps'].get(key)
+        if step is None:
+            continue
+        for statistic in ('p50', 'p90'):
+            limit = base[statistic] * (1 + tolerance)
+            if step[statistic] > limit and \
+                    step[statistic] - base[statistic] > NOISE_FLOOR:
+                regressions.append('%s %s: %.1fms, baseline %.1fms' %
+                                   (key, statistic, step[statistic],
+                                    base[statistic]))
+
+    for key in ('peak_rss', 'peak_budget'):
+        if results[key] > baseline[key] * (1 + tolerance):
+            regressions.append('%s: %dKB, baseline %dKB' %
+                               (key, results[key] // 1024,
+                                baseline[key] // 1024))
+    return regressions
+
+
+def print_results(results):
+    print('%-24s %6s %9s %9s %9s %9s' %
+          ('step', 'count', 'p50', 'p90', 'p99', 'max'))
+    for key, step in sorted(results['steps'].items()):
+        print('%-24s %6d %7.1fms %7.1fms %7.1fms %7.1fms' %
+              (key, step['count'], step['p50'], step['p90'], step['p99'],
+               step['max']))
+    print('peak RSS: %dKB, peak memory budget usage: %dKB' %
+          (results['peak_rss'] // 1024, results['peak_budget'] // 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the image viewer on synthetic images.')
+    parser.add_argument('--sizes', nargs='+', choices=sorted(SIZES),
+                        default=['small', 'medium'])
+    parser.add_argument('--formats', nargs='+', choices=FORMATS,
+                        default=list(FORMATS))
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results as a baseline')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare the results to a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown allowed, as a fraction')
+    parser.add_argument('--image-surfaces', action='store_true',
+                        help='paint tiles from client memory')
+    parser.add_argument('--write-images', metavar='DIRECTORY',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.write_images:
+        write_images(args.write_images, args.sizes, args.formats)
+        return 0
+
+    directory = tempfile.mkdtemp(prefix='imageviewer-benchmark-')
+    try:
+        write_images_apart(directory, args.sizes, args.formats)
+        images = list_images(directory, args.sizes, args.formats)
+        results = run(images, args.runs, not args.image_surfaces)
+    finally:
+        shutil.rmtree(directory)
+
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
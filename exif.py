@@ -0,0 +1,142 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Read the header of JPEG files, without decoding them.
+
+Only what is needed to display a photo early is read: the size of
+the image, the EXIF orientation tag, and the embedded thumbnail.
+'''
+
+import struct
+
+ORIENTATION_TAG = 0x0112
+THUMBNAIL_OFFSET_TAG = 0x0201
+THUMBNAIL_LENGTH_TAG = 0x0202
+
+# EXIF orientation values, as the clockwise quarter turns and the
+# horizontal mirroring, applied first, that display the image
+# upright.
+ORIENTATIONS = {
+    1: (0, False),
+    2: (0, True),
+    3: (2, False),
+    4: (2, True),
+    5: (3, True),
+    6: (1, False),
+    7: (1, True),
+    8: (3, False),
+}
+
+# Start of frame markers, which carry the size of the image.  DHT,
+# JPG and DAC share the range but are not frames.
+_SOF_MARKERS = set(range(0xc0, 0xd0)) - set([0xc4, 0xc8, 0xcc])
+
+
+def is_jpeg(data):
+    return data[:2] == b'\xff\xd8'
+
+
+def parse_jpeg(data):
+    '''
+    Parse the segments at the start of a JPEG file.
+
+    Returns a (size, orientation, thumbnail) tuple: the (width,
+    height) of the image, or None if the frame header isn't in the
+    data, the (quarter turns, mirrored) orientation, and the bytes
+    of the embedded JPEG thumbnail, or None.
+    '''
+    size = None
+    orientation = ORIENTATIONS[1]
+    thumbnail = None
+
+    position = 2
+    while position + 4 <= len(data):
+        if data[position:position + 1] != b'\xff':
+            break
+        marker = ord(data[position + 1:position + 2])
+        if marker == 0xff:
+            # Fill byte.
+            position += 1
+            continue
+
+        length = struct.unpack('>H', data[position + 2:position + 4])[0]
+        segment = data[position + 4:position + 2 + length]
+
+        if marker == 0xe1 and segment[:6] == b'Exif\x00\x00':
+            orientation, thumbnail = _parse_exif(segment[6:])
+        elif marker in _SOF_MARKERS and len(segment) >= 5:
+            height, width = struct.unpack('>HH', segment[1:5])
+            size = (width, height)
+            break
+        elif marker == 0xda:
+            # Start of scan, the header is over.
+            break
+
+        position += 2 + length
+
+    return size, orientation, thumbnail
+
+
+def _parse_exif(tiff):
+    # Read the orientation from the first IFD and the thumbnail
+    # from the second one.  Broken data is ignored.
+    orientation = ORIENTATIONS[1]
+    thumbnail = None
+
+    try:
+        if tiff[:2] == b'II':
+            order = '<'
+        elif tiff[:2] == b'MM':
+            order = '>'
+        else:
+            return orientation, thumbnail
+
+        offset = struct.unpack(order + 'I', tiff[4:8])[0]
+        tags, next_offset = _read_ifd(tiff, order, offset)
+        orientation = ORIENTATIONS.get(tags.get(ORIENTATION_TAG),
+                                       orientation)
+
+        if next_offset:
+            tags, next_offset = _read_ifd(tiff, order, next_offset)
+            start = tags.get(THUMBNAIL_OFFSET_TAG)
+            length = tags.get(THUMBNAIL_LENGTH_TAG)
+            if start and length and start + length <= len(tiff):
+                thumbnail = tiff[start:start + length]
+                if not is_jpeg(thumbnail):
+                    thumbnail = None
+    except struct.error:
+        pass
+
+    return orientation, thumbnail
+
+
+def _read_ifd(tiff, order, offset):
+    # Return the short and long values of the entries of the IFD,
+    # by tag, and the offset of the next IFD.
+    tags = {}
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    for index in range(count):
+        entry = offset + 2 + index * 12
+        tag, kind = struct.unpack(order + 'HH', tiff[entry:entry + 4])
+        if kind == 3:
+            tags[tag] = struct.unpack(order + 'H',
+                                      tiff[entry + 8:entry + 10])[0]
+        elif kind == 4:
+            tags[tag] = struct.unpack(order + 'I',
+                                      tiff[entry + 8:entry + 12])[0]
+
+    entry = offset + 2 + count * 12
+    next_offset = struct.unpack(order + 'I', tiff[entry:entry + 4])[0]
+    return tags, next_offset
@@ -0,0 +1,154 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Opt-in tracing of where the time goes.
+
+Set the IMAGEVIEWER_TRACE environment variable to record timed spans,
+which are written when the process exits in the Chrome trace event
+format, to be loaded in chrome://tracing or ui.perfetto.dev.  The
+variable is the path of the file to write, or if it is not a path,
+such as 1, the file is imageviewer-trace-<pid>.json in the temporary
+directory.
+
+When tracing is off, span() and traced() cost next to nothing:
+
+    with perftrace.span('decode', size=size):
+        ...
+
+    @perftrace.traced('convert')
+    def convert(...):
+        ...
+'''
+
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+ENVIRONMENT_VARIABLE = 'IMAGEVIEWER_TRACE'
+
+_events = []
+_thread_names = {}
+_lock = threading.Lock()
+
+
+def _get_trace_path():
+    path = os.environ.get(ENVIRONMENT_VARIABLE)
+    if not path:
+        return None
+    if os.sep not in path and not path.endswith('.json'):
+        path = os.path.join(tempfile.gettempdir(),
+                            'imageviewer-trace-%d.json' % os.getpid())
+    return path
+
+
+_path = _get_trace_path()
+ENABLED = _path is not None
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    def __init__(self, name, args):
+        self._name = name
+        self._args = args
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time()
+        thread = threading.current_thread()
+        event = {
+            'name': self._name,
+            'cat': 'imageviewer',
+            'ph': 'X',
+            'ts': int(self._start * 1e6),
+            'dur': int((end - self._start) * 1e6),
+            'pid': os.getpid(),
+            'tid': thread.ident,
+        }
+        if self._args:
+            event['args'] = self._args
+
+        with _lock:
+            _thread_names.setdefault(thread.ident, thread.name)
+            _events.append(event)
+        return False
+
+
+def span(name, **args):
+    # Context manager timing its block as a span, with the keyword
+    # arguments shown as the span arguments.
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name):
+    # Decorator timing every call of the function as a span.
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        def wrapper(*args, **kwargs):
+            with _Span(name, None):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+
+def save():
+    # Write the spans recorded so far.
+    if not ENABLED:
+        return
+
+    with _lock:
+        events = list(_events)
+        for ident, thread_name in _thread_names.items():
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': os.getpid(), 'tid': ident,
+                           'args': {'name': thread_name}})
+
+    try:
+        with open(_path, 'w') as trace_file:
+            json.dump({'traceEvents': events,
+                       'displayTimeUnit': 'ms'}, trace_file)
+    except (IOError, OSError) as error:
+        logging.error('Could not write the trace to %s: %s', _path, error)
+        return
+    logging.info('Trace of %d spans written to %s', len(_events), _path)
+
+
+if ENABLED:
+    atexit.register(save)
@@ -0,0 +1,145 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Index the pages of TIFF files, without decoding them.
+
+Only the chain of image file directories is read, a few bytes per
+page.  A page is then read through a PageStream, which presents the
+file as if the page were its first one, the only one GdkPixbuf
+decodes.
+'''
+
+import struct
+
+NEW_SUBFILE_TYPE_TAG = 0x00fe
+
+# Bit of the NewSubfileType tag set on reduced resolution copies of
+# a page, such as thumbnails, which aren't pages of their own.
+_REDUCED_RESOLUTION = 0x1
+
+# Bound on the directories followed, against broken files.
+MAX_PAGES = 10000
+
+# Byte order, whether the file is a BigTIFF, with 64 bits offsets,
+# and the offset of the first directory, by the header formats.
+_HEADERS = {
+    b'II*\x00': ('<', False),
+    b'MM\x00*': ('>', False),
+    b'II+\x00': ('<', True),
+    b'MM\x00+': ('>', True),
+}
+
+
+def is_tiff(data):
+    return data[:4] in _HEADERS
+
+
+def read_page_offsets(tiff_file):
+    '''
+    Read the offsets of the directories of the pages of a TIFF file,
+    from a file object open in binary mode.
+
+    Reduced resolution copies of the pages are skipped.  Reading
+    stops at the first broken directory, the pages before it are
+    returned.
+    '''
+    header = tiff_file.read(16)
+    if not is_tiff(header):
+        return []
+    order, bigtiff = _HEADERS[header[:4]]
+    if bigtiff:
+        offset = struct.unpack(order + 'Q', header[8:16])[0]
+    else:
+        offset = struct.unpack(order + 'I', header[4:8])[0]
+
+    offsets = []
+    seen = set()
+    try:
+        while offset and offset not in seen and len(seen) < MAX_PAGES:
+            seen.add(offset)
+            subfile_type, next_offset = _read_ifd(tiff_file, order,
+                                                  bigtiff, offset)
+            if not subfile_type & _REDUCED_RESOLUTION:
+                offsets.append(offset)
+            offset = next_offset
+    except struct.error:
+        pass
+    return offsets
+
+
+def _read_ifd(tiff_file, order, bigtiff, offset):
+    # Return the NewSubfileType of the directory at the offset, and
+    # the offset of the next directory.
+    if bigtiff:
+        count_format, entry_size, offset_format = 'Q', 20, 'Q'
+    else:
+        count_format, entry_size, offset_format = 'H', 12, 'I'
+    count_size = struct.calcsize(count_format)
+    offset_size = struct.calcsize(offset_format)
+
+    tiff_file.seek(offset)
+    count = struct.unpack(order + count_format,
+                          tiff_file.read(count_size))[0]
+    entries = tiff_file.read(count * entry_size + offset_size)
+
+    subfile_type = 0
+    for index in range(count):
+        entry = entries[index * entry_size:(index + 1) * entry_size]
+        tag = struct.unpack(order + 'H', entry[:2])[0]
+        if tag == NEW_SUBFILE_TYPE_TAG:
+            # A LONG, whose value is at the start of the value field.
+            value_start = 12 if bigtiff else 8
+            subfile_type = struct.unpack(
+                order + 'I', entry[value_start:value_start + 4])[0]
+
+    next_offset = struct.unpack(order + offset_format,
+                                entries[count * entry_size:])[0]
+    return subfile_type, next_offset
+
+
+class PageStream(object):
+    """
+    Read a TIFF file as if the page whose directory is at the offset
+    were its first one.
+
+    Only the offset of the first directory in the header is changed,
+    the rest of the file is read as it is, so all the offsets stay
+    valid.
+    """
+
+    def __init__(self, path, offset):
+        self._file = open(path, 'rb')
+        header = self._file.read(16)
+        order, bigtiff = _HEADERS.get(header[:4], ('<', False))
+        if bigtiff:
+            self._header = header[:8] + struct.pack(order + 'Q', offset)
+        else:
+            self._header = header[:4] + struct.pack(order + 'I', offset) + \
+                header[8:]
+
+    def read(self, size=-1):
+        data = self._header
+        if size < 0:
+            self._header = b''
+            return data + self._file.read()
+
+        self._header = data[size:]
+        data = data[:size]
+        if len(data) < size:
+            data += self._file.read(size - len(data))
+        return data
+
+    def close(self):
+        self._file.close()